@@ -1,8 +1,18 @@
 import streamlit as st
-from llm_communication import student_llm, get_tasks_data, reset_todocli
+from llm_communication import (
+    student_llm,
+    get_tasks_data,
+    reset_todocli,
+    ExecutionSession,
+    TodoCommandError,
+)
 import pandas as pd
 
 # Initialize the session states
+# The LLM plan of this session waiting to be run or confirmed.
+if "execution_session" not in st.session_state:
+    st.session_state["execution_session"] = ExecutionSession()
+
 if "cleanup_intended" not in st.session_state:
     st.session_state["cleanup_intended"] = False
 
@@ -21,12 +31,28 @@ if "confirmation_callback_confirmed" not in st.session_state:
 if "confirmation_callback_not_confirmed" not in st.session_state:
     st.session_state["confirmation_callback_not_confirmed"] = None
 
+# Why the last plan failed, shown once after the rerun.
+if "execution_error" not in st.session_state:
+    st.session_state["execution_error"] = ""
+
 
 def set_cleanup_intended():
     # Set the state to indicate the action is confirmed
     st.session_state["cleanup_intended"] = True
 
 
+def report_execution_error(e):
+    # The plan was rolled back, so none of its commands are left applied.
+    st.session_state["execution_error"] = f"That didn't work, nothing was changed: {e}"
+
+
+def run_confirmed_plan(callback):
+    try:
+        callback()
+    except TodoCommandError as e:
+        report_execution_error(e)
+
+
 def perform_cleanup():
     # Perform the action
     st.session_state["cleanup_intended"] = False  # Reset confirmation flag
@@ -59,9 +85,20 @@ cols = st.columns([1, 4, 1])
 with cols[1]:
     st.dataframe(data, width=500)
 
+    if st.session_state["execution_error"]:
+        st.error(st.session_state["execution_error"])
+        st.session_state["execution_error"] = ""
+
     # Request Submission
     if st.button("Submit"):
-        student_llm(user_input, cleanup=False)
+        try:
+            student_llm(
+                user_input,
+                cleanup=False,
+                session=st.session_state["execution_session"],
+            )
+        except TodoCommandError as e:
+            report_execution_error(e)
         st.rerun()
 
     # Confirmation
@@ -71,7 +108,8 @@ with cols[1]:
         st.session_state["confirmation_message"] = ""
         st.button(
             "Yes, looks good!",
-            on_click=st.session_state["confirmation_callback_confirmed"],
+            on_click=run_confirmed_plan,
+            args=(st.session_state["confirmation_callback_confirmed"],),
         )
         st.button(
             "No, stop that!",
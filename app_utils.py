@@ -1,7 +1,12 @@
-import streamlit as st
+import sys
+
+# streamlit is imported on use, so llm_communication can be imported without it
+# by the tests and scripts.
 
 
 def get_user_confirmation(message, callbacks):
+    import streamlit as st
+
     st.session_state["confirmation_callback_confirmed"] = callbacks[0]
     st.session_state["confirmation_callback_not_confirmed"] = callbacks[1]
     st.session_state["confirmation_needed"] = True
@@ -10,4 +15,9 @@ def get_user_confirmation(message, callbacks):
 
 
 def set_raw_llm_response(text):
+    # Headless callers (service.py) never load streamlit and have no session to
+    # keep the response in.
+    st = sys.modules.get("streamlit")
+    if st is None:
+        return
     st.session_state["raw_llm_response"] = text
@@ -0,0 +1,494 @@
+"""
+Micro-benchmarks for the hot paths of the task manager.
+
+Usage:
+    python benchmarks.py [benchmark ...]
+
+Without arguments every benchmark is run.
+"""
+
+import os
+import json
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import subprocess
+
+from search_utils import TaskTitleIndex
+from parsing_utils import (
+    strip_ansi,
+    fix_json_literals,
+    standardize_date_format,
+    parse_tasks_data,
+)
+from stub_servers import start_llm_stub
+from execution_utils import plan_batches
+
+WORDS = [
+    "write", "study", "math", "planning", "call", "mom", "buy", "bananas",
+    "apples", "clean", "kitchen", "water", "the", "pots", "report", "review",
+    "meeting", "team", "project", "proposal", "client", "emails", "doctor",
+    "appointment", "gym", "swimming", "paris", "flight", "book", "homework",
+]  # fmt: skip
+
+
+def random_titles(n, seed=0):
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))) + f" {i}"
+        for i in range(n)
+    ]
+
+
+def report(name, seconds, repeat):
+    print(f"{name:<50} {seconds / repeat * 1000:10.4f} ms")
+
+
+def bench_title_index():
+    for n in (1_000, 100_000):
+        titles = random_titles(n)
+        start = time.perf_counter()
+        index = TaskTitleIndex((hex(i)[2:], title) for i, title in enumerate(titles))
+        report(f"title_index build n={n}", time.perf_counter() - start, 1)
+
+        for query in ("bananas 4", f"kitchen {n - 1}", "team meeting", "zzz"):
+            start = time.perf_counter()
+            for _ in range(100):
+                index.find(query)
+            report(
+                f"title_index find {query!r} n={n}", time.perf_counter() - start, 100
+            )
+
+            start = time.perf_counter()
+            for _ in range(100):
+                [t for t in titles if query in t.lower()]
+            report(f"linear scan {query!r} n={n}", time.perf_counter() - start, 100)
+
+
+def todocli_output(n, seed=0):
+    """
+    Fake, coloured `todo search` and `todo history` output for n tasks, in
+    the layout todocli prints them.
+    """
+    rng = random.Random(seed)
+    titles = random_titles(n, seed)
+    search, history = [], []
+    for i, title in enumerate(titles, 1):
+        id, done = f"{i:x}", rng.random() < 0.3
+        line = f" \x1b[33m{id}\x1b[0m | "
+        if done:
+            line += "\x1b[32m[DONE]\x1b[0m "
+        line += title
+        if rng.random() < 0.2:
+            line += " \u231b \x1b[36m\u231b 3 days remaining\x1b[0m"
+        line += f" \x1b[32m\u2605{rng.randint(1, 9)}\x1b[0m \x1b[36m#ctx{i % 20}\x1b[0m"
+        search.append(line)
+        history.append(
+            f"{id:>6} {title[:36]:<36} 2024-01-01 10:00:00 ctx{i % 20:<9} "
+            + ("DONE  " if done else "      ")
+        )
+    header = "id     title                                created             context      status\n"
+    header += "------ ------------------------------------ ------------------- ------------ ------\n"
+    return "\n".join(search) + "\n", header + "\n".join(history) + "\n"
+
+
+def llm_response(n):
+    calls = [
+        '{"function": "todo_task", "parameters": {"id": "%x", "deadline": "%d/%d/2025 10:00:00", "front": True, "period": None}}'
+        % (i, i % 12 + 1, i % 28 + 1)
+        for i in range(n)
+    ]
+    return "[" + ", ".join(calls) + "]"
+
+
+def bench_parsing():
+    for n in [10, 1000, 100_000]:
+        search, history = todocli_output(n)
+        response = llm_response(n)
+        repeat = max(1, 10_000 // n)
+        for name, func, args in [
+            ("strip_ansi", strip_ansi, (search,)),
+            ("parse_tasks_data", parse_tasks_data, (strip_ansi(search), history)),
+            ("fix_json_literals", fix_json_literals, (response,)),
+            ("standardize_date_format", standardize_date_format, (response,)),
+        ]:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                func(*args)
+            seconds = (time.perf_counter() - start) / repeat
+            print(
+                f"{name + f' n={n}':<50} {seconds * 1000:10.4f} ms"
+                f" {seconds / n * 1e6:8.3f} us/task"
+            )
+
+
+def make_todocli_db(directory, n, seed=0):
+    # todocli uses ./.toduh when it exists; let it create the schema, then bulk insert.
+    data_dir = os.path.join(directory, ".toduh")
+    os.makedirs(data_dir)
+    subprocess.run(["todo", "add", "init"], cwd=directory, capture_output=True)
+    rng = random.Random(seed)
+    connection = sqlite3.connect(os.path.join(data_dir, "data.sqlite"))
+    with connection:
+        connection.execute("DELETE FROM Task")
+        connection.executemany(
+            "INSERT OR IGNORE INTO Context (path) VALUES (?)",
+            [(f".{word}",) for word in WORDS],
+        )
+        contexts = [row[0] for row in connection.execute("SELECT id FROM Context")]
+        connection.executemany(
+            "INSERT INTO Task (title, priority, context, done) VALUES (?, ?, ?, ?)",
+            [
+                (
+                    title,
+                    rng.randint(1, 5),
+                    rng.choice(contexts),
+                    "2024-01-01 00:00:00" if rng.random() < 0.3 else None,
+                )
+                for title in random_titles(n, seed)
+            ],
+        )
+    connection.close()
+    return data_dir
+
+
+def bench_tasks_data_source():
+    os.environ.setdefault("OPENWEATHERMAP_API_KEY", "benchmark")
+    import llm_communication
+    from todocli_utils import read_tasks_data
+
+    cwd = os.getcwd()
+    for n in [10, 1000, 10_000]:
+        with tempfile.TemporaryDirectory() as directory:
+            data_dir = make_todocli_db(directory, n)
+            os.chdir(directory)
+            llm_communication.todo_data_dir = data_dir
+            try:
+                repeat = max(1, 1000 // n)
+                for name, func in [
+                    ("scrape todocli", llm_communication.scrape_tasks_data),
+                    ("read sqlite", lambda: read_tasks_data(data_dir)),
+                    (
+                        "read sqlite, context filter",
+                        lambda: read_tasks_data(data_dir, context="gym"),
+                    ),
+                ]:
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        func()
+                    report(f"{name} n={n}", time.perf_counter() - start, repeat)
+            finally:
+                os.chdir(cwd)
+                llm_communication.todo_data_dir = None
+
+
+def portfolio_queue(llm_communication, titles):
+    # Eight adds, three renames and three removals, as a portfolio response has.
+    calls = [
+        {
+            "function": "todo_add",
+            "parameters": {"title": f"new task {i}", "context": "work"},
+        }
+        for i in range(8)
+    ]
+    calls += [
+        {"function": "todo_task", "parameters": {"id": title, "title": f"renamed {i}"}}
+        for i, title in enumerate(titles[:3])
+    ]
+    calls += [
+        {"function": "todo_rm", "parameters": {"ids": [title]}} for title in titles[3:6]
+    ]
+    llm_communication.parse_llm_output_and_populate_commands(
+        f"<JSON>{json.dumps(calls)}</JSON>"
+    )
+    return llm_communication.execution_queue
+
+
+def bench_execute_commands():
+    os.environ.setdefault("OPENWEATHERMAP_API_KEY", "benchmark")
+    import llm_communication
+    from todocli_utils import run_todo_command
+
+    def sequential():
+        for func, func_params, _ in llm_communication.execution_queue:
+            func(**func_params)
+
+    def batched():
+        for batch in plan_batches(llm_communication.execution_queue):
+            llm_communication.execute_batch(batch)
+
+    cwd = os.getcwd()
+    for name, execute in [
+        ("sequential", sequential),
+        ("batched", batched),
+        ("batched, dependency graph", llm_communication.execute_commands),
+    ]:
+        with tempfile.TemporaryDirectory() as directory:
+            data_dir = make_todocli_db(directory, 100)
+            os.chdir(directory)
+            llm_communication.todo_data_dir = data_dir
+            processes = 0
+            run = subprocess.run
+
+            def counting_run(*args, **kwargs):
+                nonlocal processes
+                processes += 1
+                return run(*args, **kwargs)
+
+            try:
+                # Start the todocli worker of this directory, a long-lived
+                # process has it running already.
+                run_todo_command("todo --location")
+                portfolio_queue(llm_communication, random_titles(100))
+                subprocess.run = counting_run
+                start = time.perf_counter()
+                execute()
+                seconds = time.perf_counter() - start
+            finally:
+                subprocess.run = run
+                os.chdir(cwd)
+                llm_communication.todo_data_dir = None
+                llm_communication.empty_execution_queue()
+            report(f"execute_commands {name} ({processes} processes)", seconds, 1)
+
+
+def bench_transaction_snapshot():
+    from transaction_utils import snapshot_data_dir, restore_data_dir
+
+    for n in [10, 1000, 10_000]:
+        with tempfile.TemporaryDirectory() as directory:
+            data_dir = make_todocli_db(directory, n)
+            repeat = 20
+            for name, func in [
+                ("snapshot", snapshot_data_dir),
+                (
+                    "restore",
+                    lambda data_dir, snapshot_dir: restore_data_dir(
+                        snapshot_dir, data_dir
+                    ),
+                ),
+            ]:
+                snapshot_dirs = [tempfile.mkdtemp(dir=directory) for _ in range(repeat)]
+                if name == "restore":
+                    for snapshot_dir in snapshot_dirs:
+                        snapshot_data_dir(data_dir, snapshot_dir)
+                start = time.perf_counter()
+                for snapshot_dir in snapshot_dirs:
+                    func(data_dir, snapshot_dir)
+                report(f"transaction {name} n={n}", time.perf_counter() - start, repeat)
+
+
+def bench_sessions():
+    os.environ.setdefault("OPENWEATHERMAP_API_KEY", "benchmark")
+    import llm_communication
+    from concurrent.futures import ThreadPoolExecutor
+
+    def user(i):
+        calls = [
+            {"function": "todo_add", "parameters": {"title": f"session {i} task {j}"}}
+            for j in range(3)
+        ]
+        session = llm_communication.ExecutionSession(confirmation_enabled=False)
+        session.populate(f"<JSON>{json.dumps(calls)}</JSON>")
+        session.execute()
+
+    cwd = os.getcwd()
+    for n in [1, 8, 32]:
+        with tempfile.TemporaryDirectory() as directory:
+            data_dir = make_todocli_db(directory, 100)
+            os.chdir(directory)
+            llm_communication.todo_data_dir = data_dir
+            try:
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=n) as executor:
+                    list(executor.map(user, range(n)))
+                seconds = time.perf_counter() - start
+            finally:
+                os.chdir(cwd)
+                llm_communication.todo_data_dir = None
+            print(
+                f"{f'{n} sessions':<50} {seconds * 1000:10.4f} ms {n / seconds:8.1f} plans/s"
+            )
+
+
+def bench_service():
+    os.environ.setdefault("OPENWEATHERMAP_API_KEY", "benchmark")
+    os.environ.setdefault("AWS_API_KEY", "benchmark")
+    import asyncio
+    import aiohttp
+    from aiohttp import web
+    import llm_communication
+    from langchain_utils import LLAMA2
+    from quota_utils import get_quota_ledger
+    from service import make_app
+
+    added = iter(range(1_000_000))
+
+    def generate(prompt):
+        title = f"service task {next(added)}"
+        return f'<JSON>[{{"function": "todo_add", "parameters": {{"title": "{title}"}}}}]</JSON>'
+
+    async def load(url, n, concurrency, method, **kwargs):
+        semaphore = asyncio.Semaphore(concurrency)
+        async with aiohttp.ClientSession() as client:
+
+            async def one():
+                async with semaphore:
+                    async with client.request(method, url, **kwargs) as response:
+                        await response.read()
+                        assert response.status == 200, response.status
+
+            start = time.perf_counter()
+            await asyncio.gather(*(one() for _ in range(n)))
+            return time.perf_counter() - start
+
+    async def run(directory, llm_url):
+        llm = LLAMA2(
+            api_url=llm_url,
+            quota_db=os.path.join(directory, "quota.sqlite"),
+            response_cache_db=os.path.join(directory, "cache.sqlite"),
+        )
+        get_quota_ledger(llm.quota_db).set(1_000_000)
+        llm_communication.get_agent_pipeline = lambda: (llm, None)
+        runner = web.AppRunner(make_app(warm=False))
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        root = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        try:
+            for name, n, method, path, kwargs in [
+                ("GET /tasks", 2000, "GET", "/tasks", {}),
+                (
+                    "POST /instructions",
+                    200,
+                    "POST",
+                    "/instructions",
+                    {"json": {"instruction": "add a task"}},
+                ),
+            ]:
+                for concurrency in [1, 16]:
+                    seconds = await load(root + path, n, concurrency, method, **kwargs)
+                    print(
+                        f"{f'{name} concurrency={concurrency}':<50} "
+                        f"{seconds / n * 1000:10.4f} ms {n / seconds:8.1f} rps"
+                    )
+        finally:
+            await runner.cleanup()
+
+    cwd = os.getcwd()
+    llm_communication.get_base_prompt()  # read from the repository, before chdir
+    get_agent_pipeline = llm_communication.get_agent_pipeline
+    server = start_llm_stub(generate)
+    with tempfile.TemporaryDirectory() as directory:
+        data_dir = make_todocli_db(directory, 100)
+        os.chdir(directory)
+        llm_communication.todo_data_dir = data_dir
+        try:
+            asyncio.run(run(directory, server.url))
+        finally:
+            os.chdir(cwd)
+            llm_communication.todo_data_dir = None
+            llm_communication.get_agent_pipeline = get_agent_pipeline
+            server.shutdown()
+            server.server_close()
+
+
+def make_self_signed_cert(directory):
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-keyout", keyfile, "-out", certfile, "-subj", "/CN=127.0.0.1",
+         "-addext", "subjectAltName=IP:127.0.0.1"],
+        check=True,
+        capture_output=True,
+    )  # fmt: skip
+    return certfile, keyfile
+
+
+def bench_llm_session():
+    from langchain_utils import LLAMA2
+
+    body = {"prompt": "x" * 10_000, "max_gen_len": 1024}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        certfile, keyfile = make_self_signed_cert(tmp_dir)
+        os.environ["REQUESTS_CA_BUNDLE"] = certfile
+        for tls in (False, True):
+            server = start_llm_stub(
+                certfile=certfile if tls else None, keyfile=keyfile if tls else None
+            )
+            try:
+                for use_session in (False, True):
+                    llm = LLAMA2(api_url=server.url, use_session=use_session)
+                    llm._post(body)  # warm up
+                    ttfb = 0
+                    for _ in range(200):
+                        ttfb += llm._post(body).elapsed.total_seconds()
+                    report(
+                        f"llm time to first byte tls={tls} use_session={use_session}",
+                        ttfb,
+                        200,
+                    )
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+def bench_agent_pipeline():
+    os.environ.setdefault("OPENWEATHERMAP_API_KEY", "benchmark")
+    import llm_communication
+
+    repeat = 20
+    start = time.perf_counter()
+    for _ in range(repeat):
+        llm_communication.build_agent_pipeline()
+    report("agent pipeline build", time.perf_counter() - start, repeat)
+
+    llm_communication.get_agent_pipeline()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        llm_communication.get_agent_pipeline()
+    report("agent pipeline cached", time.perf_counter() - start, repeat)
+
+
+def import_time(module):
+    # Cumulative microseconds reported by -X importtime for a cold import.
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1])
+    raise ValueError(f"{module} not found in -X importtime output")
+
+
+def bench_import_time():
+    repeat = 5
+    for module in ["langchain_utils", "llm_communication"]:
+        samples = sorted(import_time(module) for _ in range(repeat))
+        report(f"cold import {module} (median)", samples[repeat // 2] / 1e6, 1)
+
+
+BENCHMARKS = {
+    "title_index": bench_title_index,
+    "llm_session": bench_llm_session,
+    "agent_pipeline": bench_agent_pipeline,
+    "import_time": bench_import_time,
+    "parsing": bench_parsing,
+    "tasks_data_source": bench_tasks_data_source,
+    "execute_commands": bench_execute_commands,
+    "transaction_snapshot": bench_transaction_snapshot,
+    "sessions": bench_sessions,
+    "service": bench_service,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
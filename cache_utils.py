@@ -0,0 +1,95 @@
+import time
+import json
+import hashlib
+import sqlite3
+import threading
+
+response_caches = {}
+response_caches_lock = threading.Lock()
+
+
+class ResponseCache:
+    """
+    On-disk cache of LLM generations, addressed by the SHA-256 of the request.
+
+    Entries expire `ttl` seconds after they were stored. Once the stored
+    generations exceed `max_bytes`, the least recently used ones are evicted.
+    """
+
+    def __init__(self, path, ttl=24 * 3600, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.connect().execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """)
+
+    def connect(self):
+        # One connection per thread, sqlite3 connections can't be shared.
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    @staticmethod
+    def key(prompt, **params):
+        request = json.dumps({"prompt": prompt, **params}, sort_keys=True)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def get(self, key):
+        connection = self.connect()
+        row = connection.execute(
+            "SELECT response, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > self.ttl:
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            return None
+        connection.execute(
+            "UPDATE responses SET last_used = ? WHERE key = ?", (now, key)
+        )
+        return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        connection = self.connect()
+        connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+            (key, response, len(response.encode()), now, now),
+        )
+        ## Keep the most recently used entries that fit in max_bytes.
+        connection.execute(
+            """
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (
+                        ORDER BY last_used DESC, key
+                    ) AS total
+                    FROM responses
+                )
+                WHERE total > ?
+            )
+            """,
+            (self.max_bytes,),
+        )
+
+
+def get_response_cache(path, ttl, max_bytes):
+    with response_caches_lock:
+        cache = response_caches.get(path)
+        if cache is None:
+            cache = ResponseCache(path, ttl, max_bytes)
+            response_caches[path] = cache
+        cache.ttl, cache.max_bytes = ttl, max_bytes
+        return cache
@@ -0,0 +1,99 @@
+import re
+import logging
+import threading
+
+# The weather tool needs a city and a date, and is only meant for outdoor
+# activities, so the agent runs when two of the three are mentioned.
+DATE_PATTERN = re.compile(
+    r"""
+    \b\d{4}[-/.]\d{1,2}[-/.]\d{1,2}\b
+    | \b\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4}\b
+    | \b(0?[1-9]|[12]\d|3[01])[./](0[1-9]|1[0-2])\b(?![./]\d)
+    | \bthe\s+\d{1,2}(st|nd|rd|th)\b
+    | \b\d{1,2}(:\d{2})?\s*(am|pm)\b
+    | \b\d{1,2}:\d{2}\b
+    | \b(today|tonight|tomorrow|weekend|(mon|tues|wednes|thurs|fri|satur|sun)day)\b
+    | \b(next|this|coming)\s+(week|month|year)\b
+    | \bin\s+\d+\s+(days?|weeks?)\b
+    | \b(jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?\s+\d{1,2}(st|nd|rd|th)?\b
+    | \b\d{1,2}(st|nd|rd|th)?\s+(of\s+)?(jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\b
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+OUTDOOR_PATTERN = re.compile(
+    r"""
+    \b(
+        outdoors?|outside|open[-\s]air|weather
+        | hik(e|es|ing)|walk(s|ing)?|run(s|ning)?|jog(s|ging)?|marathon
+        | cycl(e|ing)|bik(e|es|ing)|swim(s|ming)?|beach|park|garden(ing)?
+        | picnic|barbecue|bbq|camp(s|ing)?|fish(ing)?|ski(s|ing)?|surf(ing)?
+        | sail(s|ing)?|kayak(s|ing)?|climb(s|ing)?|football|soccer|tennis|golf
+        | festival|trip|excursion|mow(ing)?|sightseeing
+    )\b
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+# Month and day names are capitalised too, but they're dates. The preposition
+# may start the sentence, the place has to be capitalised.
+LOCATION_PATTERN = re.compile(
+    r"""
+    \b(?i:in|at|to|near|around)\s+
+    (?!(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|Mon|Tue|Wed|Thu|Fri|Sat|Sun)[a-z]*\b)
+    [A-Z][a-z]+
+    """,
+    re.VERBOSE,
+)
+
+
+class WeatherCheckClassifier:
+    """
+    Rule-based decision of whether an instruction can need the weather agent.
+
+    It errs on the side of running the agent: an instruction is only skipped
+    when it mentions at most one of a date, an outdoor activity and a
+    capitalised place after a preposition. Every decision is logged together
+    with the running skip rate.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.decisions = 0
+        self.skipped = 0
+
+    @staticmethod
+    def signals(instruction):
+        """
+        Find the signals the decision is based on.
+
+        Returns:
+            dict: The first match of each of "date", "outdoor" and "location", or None where there is no match.
+        """
+        signals = {}
+        for name, pattern in (
+            ("date", DATE_PATTERN),
+            ("outdoor", OUTDOOR_PATTERN),
+            ("location", LOCATION_PATTERN),
+        ):
+            match = pattern.search(instruction)
+            signals[name] = match.group(0) if match else None
+        return signals
+
+    def needs_weather_check(self, instruction):
+        signals = self.signals(instruction)
+        needed = sum(bool(signal) for signal in signals.values()) >= 2
+        with self.lock:
+            self.decisions += 1
+            self.skipped += not needed
+            skip_rate = self.skipped / self.decisions
+        logging.info(
+            f"weather agent {'needed' if needed else 'skipped'}, signals: {signals}, "
+            f"skip rate: {skip_rate:.0%} of {self.decisions}"
+        )
+        return needed
+
+    def skip_rate(self):
+        with self.lock:
+            return self.skipped / self.decisions if self.decisions else 0.0
+
+
+weather_check_classifier = WeatherCheckClassifier()
@@ -0,0 +1,281 @@
+"""
+Planning of the queued LLM function calls into as few todocli runs as possible.
+"""
+
+import re
+import threading
+
+# Consecutive calls of these functions are merged into one call with all their
+# IDs, e.g. two `todo_rm` become a single `todo rm`.
+MERGED_PARAMETERS = {"todo_rm": "ids", "todo_mark_as_done": "ids"}
+# Merged calls whose tasks are gone for the calls after them.
+REMOVING_FUNCTIONS = {"todo_rm"}
+# Consecutive calls of these functions run one after the other in one todocli session.
+SESSION_FUNCTIONS = {"todo_add"}
+# Consecutive calls of these functions have their task names resolved together.
+RESOLVED_PARAMETERS = {"todo_task": "id"}
+
+
+class Batch:
+    """
+    Consecutive queued calls that are executed together.
+
+    `kind` is "merge", "session", "resolve" or "single" (a call that runs on its own).
+    """
+
+    __slots__ = ("kind", "calls")
+
+    def __init__(self, kind, calls):
+        self.kind = kind
+        self.calls = calls
+
+    @property
+    def func(self):
+        return self.calls[0][0]
+
+    @property
+    def logs(self):
+        return [log for _, _, log in self.calls]
+
+    def call_names(self):
+        # The task names of each merged call, in order.
+        param = MERGED_PARAMETERS[self.func.__name__]
+        return [
+            [str(name) for name in as_list(func_params.get(param))]
+            for _, func_params, _ in self.calls
+        ]
+
+    def __repr__(self):
+        return f"Batch({self.kind!r}, {[func.__name__ for func, _, _ in self.calls]})"
+
+
+def batch_kind(func):
+    name = func.__name__
+    if name in MERGED_PARAMETERS:
+        return "merge"
+    if name in SESSION_FUNCTIONS:
+        return "session"
+    if name in RESOLVED_PARAMETERS:
+        return "resolve"
+    return "single"
+
+
+def plan_batches(queue):
+    """
+    Group the queued calls into batches, keeping their order.
+
+    Only consecutive calls of the same function are grouped, so every call
+    still sees the effects of the calls queued before it. A call renaming a
+    task ends its resolve batch, the names after it are resolved afterwards.
+
+    Parameters:
+        queue (list of tuple): (func, func_params, log) entries, as in `execution_queue`.
+
+    Returns:
+        list of Batch: The batches in execution order.
+    """
+    batches = []
+    for entry in queue:
+        func = entry[0]
+        kind = batch_kind(func)
+        if (
+            kind != "single"
+            and batches
+            and batches[-1].kind == kind
+            and batches[-1].func is func
+            and not (kind == "resolve" and batches[-1].calls[-1][1].get("title"))
+        ):
+            batches[-1].calls.append(entry)
+        else:
+            batches.append(Batch(kind, [entry]))
+    return batches
+
+
+# Parameters naming tasks and contexts, what calls are checked for conflicts on.
+TASK_PARAMETERS = ("ids", "id", "depends_on")
+CONTEXT_PARAMETERS = ("context", "source_ctx", "destination_ctx")
+# Calls that neither change nor show any task.
+INDEPENDENT_FUNCTIONS = {"todo_location"}
+# Calls that show tasks without changing them.
+READ_FUNCTIONS = {"todo_list", "todo_search", "todo_history", "todo_future"}
+# Calls that change the tasks they're given. Any other call may change every
+# task (todo_purge, todo_mv, todo_rmctx, todo_edit_ctx).
+TASK_WRITE_FUNCTIONS = {
+    "todo_add",
+    "todo_task",
+    "todo_rm",
+    "todo_mark_as_done",
+    "todo_ping",
+}
+HEX_ID_PATTERN = re.compile(r"[0-9a-f]+")
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return [value] if isinstance(value, (str, int)) else list(value)
+
+
+class Footprint:
+    """
+    What a batch reads and changes, to tell whether two batches can run concurrently.
+
+    `kind` is "none", "read", "write" or "global". `tasks` are the IDs of the
+    existing tasks the batch refers to, `names` the names that aren't IDs,
+    `titles` the titles it creates or renames tasks to.
+    """
+
+    __slots__ = ("kind", "tasks", "names", "contexts", "titles", "adds")
+
+    def __init__(self, kind="none"):
+        self.kind = kind
+        self.tasks = set()
+        self.names = set()
+        self.contexts = set()
+        self.titles = set()
+        self.adds = False
+
+    def refers_to_new_task(self, titles):
+        # Names that may resolve differently once tasks with these titles exist.
+        return any(
+            name in title or HEX_ID_PATTERN.fullmatch(name)
+            for name in self.names
+            for title in titles
+        )
+
+    def conflicts_with(self, other):
+        kinds = {self.kind, other.kind}
+        if "none" in kinds:
+            return False
+        if "global" in kinds:
+            return True
+        if "read" in kinds:
+            return kinds != {"read"}
+        ## Adds stay in order so that the tasks get the same IDs.
+        if self.adds and other.adds:
+            return True
+        if self.tasks & other.tasks or self.names & other.names:
+            return True
+        if any(contexts_overlap(a, b) for a in self.contexts for b in other.contexts):
+            return True
+        return self.refers_to_new_task(other.titles) or other.refers_to_new_task(
+            self.titles
+        )
+
+
+def contexts_overlap(a, b):
+    # A context overlaps with itself and its subcontexts.
+    return a == b or a.startswith(b + ".") or b.startswith(a + ".")
+
+
+def batch_footprint(batch, resolve):
+    """
+    Parameters:
+        batch (Batch): The batch.
+        resolve (callable): Maps a list of task names to the set of IDs of the existing tasks each of them matches. An ID of an existing task maps to itself.
+
+    Returns:
+        Footprint: Everything the batch's calls read and change.
+    """
+    footprint = Footprint()
+    kinds = []
+    for func, func_params, _ in batch.calls:
+        name = func.__name__
+        if name in INDEPENDENT_FUNCTIONS:
+            continue
+        if name in READ_FUNCTIONS:
+            kinds.append("read")
+        elif name in TASK_WRITE_FUNCTIONS:
+            kinds.append("write")
+        else:
+            kinds.append("global")
+
+        names = [
+            str(task_name)
+            for param in TASK_PARAMETERS
+            for task_name in as_list(func_params.get(param))
+        ]
+        for task_name, ids in zip(names, resolve(names)):
+            footprint.tasks |= ids
+            if task_name not in ids:
+                footprint.names.add(task_name.lower())
+        for param in CONTEXT_PARAMETERS:
+            if func_params.get(param):
+                footprint.contexts.add(str(func_params[param]))
+        if name in ("todo_add", "todo_task") and func_params.get("title"):
+            footprint.titles.add(str(func_params["title"]).lower())
+        footprint.adds |= name == "todo_add"
+
+    for kind in ("global", "write", "read"):
+        if kind in kinds:
+            footprint.kind = kind
+            break
+    return footprint
+
+
+def plan_dependencies(batches, resolve):
+    """
+    Build the dependency graph of the batches.
+
+    A batch depends on every earlier batch it conflicts with: both change or
+    one shows the same tasks or contexts, one creates or renames a task the
+    other refers to by name, or both add tasks.
+
+    Returns:
+        list of set: For every batch, the indices of the earlier batches it has to wait for.
+    """
+    footprints = [batch_footprint(batch, resolve) for batch in batches]
+    return [
+        {j for j in range(i) if footprint.conflicts_with(footprints[j])}
+        for i, footprint in enumerate(footprints)
+    ]
+
+
+def run_dependency_graph(items, dependencies, run, executor):
+    """
+    Run `run(item)` for every item on the executor, each as soon as the items it depends on are done.
+
+    After a failure no further items are started. Once the running ones are
+    done, the exception of the earliest failed item is raised.
+
+    Parameters:
+        items (list): The items, in their original order.
+        dependencies (list of set): For every item, the indices of the earlier items it has to wait for.
+        run (callable): Called with each item.
+        executor (concurrent.futures.Executor): Runs the calls.
+    """
+    pending = [set(deps) for deps in dependencies]
+    dependents = [[] for _ in items]
+    for i, deps in enumerate(dependencies):
+        for j in deps:
+            dependents[j].append(i)
+    condition = threading.Condition()
+    running = 0
+    errors = {}
+
+    def start(i):
+        nonlocal running
+        running += 1
+        future = executor.submit(run, items[i])
+        future.add_done_callback(lambda future: finish(i, future))
+
+    def finish(i, future):
+        nonlocal running
+        with condition:
+            running -= 1
+            if future.exception() is not None:
+                errors[i] = future.exception()
+            elif not errors:
+                for k in dependents[i]:
+                    pending[k].discard(i)
+                    if not pending[k]:
+                        start(k)
+            condition.notify_all()
+
+    with condition:
+        for i in range(len(items)):
+            if not pending[i]:
+                start(i)
+        condition.wait_for(lambda: running == 0)
+    if errors:
+        raise errors[min(errors)]
@@ -1,34 +1,95 @@
-from typing import Any, Optional
+from typing import Any, Iterator, List, Optional
 import logging
 import time
+import asyncio
+import threading
+import contextvars
 import requests
 import os
 import json
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+from quota_utils import get_quota_ledger
+from retry_utils import RetryPolicy
+from cache_utils import ResponseCache, get_response_cache
 
 from langchain_core.pydantic_v1 import BaseModel
 from langchain_core.utils import get_from_dict_or_env
-from langchain_core.callbacks.manager import CallbackManagerForLLMRun
+from langchain_core.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
 from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
 
-import pyowm
-from pyowm.commons.exceptions import NotFoundError
+# aiohttp and pyowm are imported where they're used, most processes never
+# touch them and they're slow to import.
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
     handlers=[
-        logging.FileHandler("debug.log"),
+        logging.FileHandler("debug.log", delay=True),
         # logging.StreamHandler()
     ],
 )
 
+# Shared by all LLAMA2 instances so keep-alive connections are reused across
+# calls. One session per host, so that hosts don't evict each other's pool.
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+
+def get_http_session(url, pool_size):
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc, pool_size)
+    with http_sessions_lock:
+        session = http_sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_sessions[key] = session
+        return session
+
+
+# aiohttp sessions are bound to an event loop, so ainvoke_many shares one with
+# the requests of its batch through this context variable.
+aiohttp_session = contextvars.ContextVar("aiohttp_session", default=None)
+
 
 class LLAMA2(LLM):
     api_url = "https://6xtdhvodk2.execute-api.us-west-2.amazonaws.com/dsa_llm/generate"
+    quota_db = "./aws_api_quota.sqlite"
+    # Legacy plain-text quota, used to seed an empty ledger
+    quota_file = "./aws_api_quota_remaining"
+    # Attempts per prompt, and the backoff and overall deadline between them
     retries = 3
+    backoff_base = 1.0
+    backoff_max = 20.0
+    retry_deadline = 120.0
     max_gen_len = 1024
     temperature = 0.2
     top_p = 0.9
+    # Connection pooling and per-attempt (connect, read) timeouts in seconds
+    use_session = True
+    pool_size = 10
+    connect_timeout = 5
+    read_timeout = 30
+    # Requests ainvoke_many keeps in flight at once
+    max_concurrency = 4
+    # On-disk cache of generations, skipped if disabled or bypass_cache=True is passed
+    use_response_cache = True
+    response_cache_db = "./llm_cache.sqlite"
+    response_cache_ttl = 24 * 3600
+    response_cache_max_bytes = 50 * 1024 * 1024
+    # Whether the endpoint (stream_url, defaults to api_url) can stream the
+    # generation as newline-delimited {"generation": ...} chunks.
+    streaming = False
+    stream_url: Optional[str] = None
 
     @property
     def _llm_type(self) -> str:
@@ -40,44 +101,281 @@ class LLAMA2(LLM):
         run_manager: Optional[CallbackManagerForLLMRun] = None,
         **kwargs: Any,
     ) -> str:
-        with open("./aws_api_quota_remaining", "r") as f:
-            aws_api_quota_remaining = int(f.readlines()[0].strip())
-        body = {
+        cache_key = self._cache_key(prompt, kwargs)
+        cached = self._response_cache().get(cache_key) if cache_key else None
+        if cached:
+            logging.info("LLM response served from cache")
+            return cached
+
+        body = self._request_body(prompt)
+        retry = self._retry_policy().start()
+        while True:
+            try:
+                res = self._post(body, retry.timeout(self.read_timeout))
+            except (
+                requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError,
+            ) as e:
+                logging.info(f"LLM request failed: {e!r}")
+                result, retryable, retry_after = "", True, None
+            else:
+                result, retryable = self._handle_response(res.status_code, res.text)
+                retry_after = res.headers.get("Retry-After")
+            if result or not retryable:
+                break
+            delay = retry.next_delay(retry_after)
+            if delay is None:
+                break
+            logging.info(f"retrying LLM request in {delay:.2f}s")
+            time.sleep(delay)
+
+        return self._check_result(result, cache_key)
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        import aiohttp
+
+        cache_key = self._cache_key(prompt, kwargs)
+        cached = self._response_cache().get(cache_key) if cache_key else None
+        if cached:
+            logging.info("LLM response served from cache")
+            return cached
+
+        body = self._request_body(prompt)
+        retry = self._retry_policy().start()
+        while True:
+            try:
+                status, text, retry_after = await self._apost(
+                    body, retry.timeout(self.read_timeout)
+                )
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                logging.info(f"LLM request failed: {e!r}")
+                result, retryable, retry_after = "", True, None
+            else:
+                result, retryable = self._handle_response(status, text)
+            if result or not retryable:
+                break
+            delay = retry.next_delay(retry_after)
+            if delay is None:
+                break
+            logging.info(f"retrying LLM request in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+        return self._check_result(result, cache_key)
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        cache_key = self._cache_key(prompt, kwargs)
+        cached = self._response_cache().get(cache_key) if cache_key else None
+        if not self.streaming or cached:
+            yield GenerationChunk(text=cached or self._call(prompt, **kwargs))
+            return
+
+        body = {**self._request_body(prompt), "stream": True}
+        try:
+            res = self._post(body, url=self.stream_url or self.api_url, stream=True)
+            res.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            # Nothing was generated yet, the regular call can take care of retrying.
+            logging.info(f"LLM streaming request failed: {e!r}")
+            yield GenerationChunk(text=self._call(prompt, **kwargs))
+            return
+
+        self._consume_quota()
+        result = ""
+        ## The consumer may stop early, closing the response stops the generation.
+        with res:
+            for line in res.iter_lines(decode_unicode=True):
+                if not line:
+                    continue
+                chunk = GenerationChunk(text=json.loads(line)["generation"])
+                result += chunk.text
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+        self._check_result(result, cache_key)
+
+    def _retry_policy(self):
+        return RetryPolicy(
+            max_attempts=self.retries,
+            base_delay=self.backoff_base,
+            max_delay=self.backoff_max,
+            deadline=self.retry_deadline,
+        )
+
+    def _handle_response(self, status, text):
+        """
+        Account for one response of the endpoint and classify it.
+
+        Returns:
+            tuple: The generation ("" if there is none) and whether the request is worth retrying.
+        """
+        # Throttled requests are rejected by the gateway before reaching the model.
+        if status != 429:
+            self._consume_quota()
+        if status == 429 or status >= 500:
+            logging.info(f"LLM endpoint returned {status}")
+            return "", True
+        if status >= 400:
+            logging.info(f"LLM endpoint rejected the request with {status}:\n{text}")
+            return "", False
+        try:
+            return json.loads(text)["body"]["generation"], True
+        except (ValueError, KeyError, TypeError):
+            logging.info(f"LLM response is empty. The response text:\n{text}")
+            return "", True
+
+    def _request_body(self, prompt):
+        return {
             "prompt": prompt,
             "max_gen_len": self.max_gen_len,
             "temperature": self.temperature,
             "top_p": self.top_p,
             "api_token": os.environ["AWS_API_KEY"],
         }
-        result = ""
-        # Retry for i times if request timed out
-        for i in range(self.retries):
-            try:
-                res = requests.post(self.api_url, json=body, timeout=30)
-            except requests.exceptions.Timeout as e:
-                logging.info(f"LLM response timeout")
-                time.sleep(5)
-                continue
-
-            aws_api_quota_remaining -= 1
-            with open("./aws_api_quota_remaining", "w") as f:
-                f.write(str(aws_api_quota_remaining))
-            logging.info(f"ramining AWS API calls: {aws_api_quota_remaining}")
-            try:
-                result = json.loads(res.text)["body"]["generation"]
-                break
-            except KeyError:
-                logging.info(f"LLM response is empty. The response text:\n{res.text}")
-                time.sleep(5)
 
+    def _cache_key(self, prompt, kwargs):
+        if kwargs.get("bypass_cache", not self.use_response_cache):
+            return None
+        return ResponseCache.key(
+            prompt,
+            api_url=self.api_url,
+            max_gen_len=self.max_gen_len,
+            temperature=self.temperature,
+            top_p=self.top_p,
+        )
+
+    def _response_cache(self):
+        return get_response_cache(
+            self.response_cache_db,
+            self.response_cache_ttl,
+            self.response_cache_max_bytes,
+        )
+
+    def _check_result(self, result, cache_key=None):
         if result:
             logging.info(
                 f"Raw LLM response:\n----------\n{result}\n----------",
             )
+            if cache_key:
+                self._response_cache().put(cache_key, result)
             return result
         else:
             raise Exception("Failed to get response from LLM")
 
+    def get_remaining_quota(self):
+        return get_quota_ledger(self.quota_db, self.quota_file).remaining()
+
+    def _consume_quota(self):
+        aws_api_quota_remaining = get_quota_ledger(
+            self.quota_db, self.quota_file
+        ).decrement()
+        logging.info(f"ramining AWS API calls: {aws_api_quota_remaining}")
+
+    def _post(self, body, read_timeout=None, url=None, stream=False):
+        url = url or self.api_url
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        if self.use_session:
+            session = get_http_session(url, self.pool_size)
+            return session.post(url, json=body, timeout=timeout, stream=stream)
+        return requests.post(url, json=body, timeout=timeout, stream=stream)
+
+    async def _apost(self, body, read_timeout=None):
+        import aiohttp
+
+        session = aiohttp_session.get()
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self._apost_with(session, body, read_timeout)
+        return await self._apost_with(session, body, read_timeout)
+
+    async def _apost_with(self, session, body, read_timeout):
+        import aiohttp
+
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.connect_timeout,
+            sock_read=read_timeout or self.read_timeout,
+        )
+        async with session.post(self.api_url, json=body, timeout=timeout) as res:
+            return res.status, await res.text(), res.headers.get("Retry-After")
+
+
+async def ainvoke_many(llm, prompts, max_concurrency=None):
+    """
+    Run several prompts through the LLM concurrently.
+
+    Parameters:
+        llm (LLAMA2): The model to invoke.
+        prompts (list of str): The prompts to run.
+        max_concurrency (int, optional): Maximum number of requests in flight. Defaults to llm.max_concurrency. It is further capped by the remaining AWS API quota.
+
+    Returns:
+        list: The generations in the order of the prompts. A prompt that failed, or that was not sent because the quota ran out, has its exception in place of the generation.
+    """
+    import aiohttp
+
+    limit = min(max_concurrency or llm.max_concurrency, llm.get_remaining_quota())
+    if limit <= 0:
+        raise Exception("AWS API quota exhausted")
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(prompt):
+        async with semaphore:
+            if llm.get_remaining_quota() <= 0:
+                raise Exception("AWS API quota exhausted")
+            return await llm.ainvoke(prompt)
+
+    connector = aiohttp.TCPConnector(limit=limit)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        token = aiohttp_session.set(session)
+        try:
+            return await asyncio.gather(
+                *(run(prompt) for prompt in prompts), return_exceptions=True
+            )
+        finally:
+            aiohttp_session.reset(token)
+
+
+def invoke_many(llm, prompts, max_concurrency=None):
+    """Blocking version of `ainvoke_many`, for scripts and tests."""
+    return asyncio.run(ainvoke_many(llm, prompts, max_concurrency))
+
+
+# 3 hourly forecasts per (API root, API key, city). OWM refreshes them every 3 hours, so
+# an entry expires at the next 3 hour boundary.
+FORECAST_REFRESH_SECONDS = 3 * 3600
+forecast_cache = {}
+forecast_cache_lock = threading.Lock()
+# pyowm clients per API key, built on first use.
+owm_clients = {}
+owm_clients_lock = threading.Lock()
+
+
+def get_owm_client(api_key=None):
+    import pyowm
+
+    api_key = get_from_dict_or_env(
+        {"openweathermap_api_key": api_key},
+        "openweathermap_api_key",
+        "OPENWEATHERMAP_API_KEY",
+    )
+    with owm_clients_lock:
+        owm = owm_clients.get(api_key)
+        if owm is None:
+            owm = pyowm.OWM(api_key)
+            owm_clients[api_key] = owm
+        return owm
+
 
 class OpenWeatherMapAPIWrapper(BaseModel):
     """Wrapper for OpenWeatherMap API using PyOWM.
@@ -89,10 +387,11 @@ class OpenWeatherMapAPIWrapper(BaseModel):
     3. pip install pyowm
     """
 
-    openweathermap_api_key = get_from_dict_or_env(
-        {}, "openweathermap_api_key", "OPENWEATHERMAP_API_KEY"
-    )
-    owm = pyowm.OWM(openweathermap_api_key)
+    # Defaults to the OPENWEATHERMAP_API_KEY env variable, read on first use.
+    openweathermap_api_key: Optional[str] = None
+    # e.g. "http://127.0.0.1:8000/data/2.5" to use another server than OWM's.
+    owm_root_uri: Optional[str] = None
+    use_forecast_cache = True
 
     class Config:
         """Configuration for this pydantic object."""
@@ -123,20 +422,67 @@ class OpenWeatherMapAPIWrapper(BaseModel):
             f"Cloud cover: {clouds}%"
         )
 
+    @property
+    def owm(self):
+        return get_owm_client(self.openweathermap_api_key)
+
+    def _weather_manager(self):
+        from pyowm.commons.http_client import HttpClient
+
+        mgr = self.owm.weather_manager()
+        if self.owm_root_uri:
+            scheme, root = self.owm_root_uri.split("://", 1)
+            config = dict(self.owm.configuration)
+            config["connection"] = {
+                **config["connection"],
+                "use_ssl": scheme == "https",
+            }
+            mgr.http_client = HttpClient(
+                self.owm.api_key, config, root, admits_subdomains=False
+            )
+        return mgr
+
+    def get_forecast(self, location):
+        """
+        Get the 5 day, 3 hourly forecast of a city, from the cache while it's fresh.
+
+        Parameters:
+            location (str): The city name.
+
+        Returns:
+            Forecaster: The forecast, `get_weather_at` looks up a single time in it.
+        """
+        from pyowm.commons.exceptions import NotFoundError
+
+        ## Another key may see other data or errors, don't share its forecasts.
+        key = (self.owm_root_uri, self.owm.api_key, location.lower())
+        now = time.time()
+        with forecast_cache_lock:
+            cached = forecast_cache.get(key)
+        if self.use_forecast_cache and cached and cached[0] > now:
+            return cached[1]
+
+        forecaster = self._weather_manager().forecast_at_place(
+            name=location, interval="3h", limit=None
+        )
+        if forecaster is None:
+            raise NotFoundError(f"No forecast available for {location}")
+        expires = (now // FORECAST_REFRESH_SECONDS + 1) * FORECAST_REFRESH_SECONDS
+        with forecast_cache_lock:
+            forecast_cache[key] = (expires, forecaster)
+        return forecaster
+
     def run(self, city_date) -> str:
         """Get the forcasted weather information for a specified city and date.
         There is only one parameter. The city_date parameter should be formatted as: CITY WITHOUT COUNTRY, DATE. Nothing more or less. The date part should be formatted like YYYY-MM-DD HH:MM:SS
         do not ever input country.
         """
+        from pyowm.commons.exceptions import NotFoundError
+
         try:
             location, date = city_date.split(",")
             location, date = location.strip(), date.strip()
-            mgr = self.owm.weather_manager()
-
-            observation = mgr.forecast_at_place(
-                name=location, interval="3h", limit=None
-            )
-            w = observation.get_weather_at(date)
+            w = self.get_forecast(location).get_weather_at(date)
         except (NotFoundError, ValueError) as e:
             logging.info(e)
             return f"Tool failed to execute. Weather forecast information not available. No response can be provided to the user."
@@ -3,21 +3,52 @@ from dotenv import load_dotenv
 load_dotenv()
 import json
 import subprocess
+import sqlite3
 import shutil
+import tempfile
 import os
 from pathlib import Path
 import logging
-from difflib import SequenceMatcher
-import inspect
-import re
-from collections import defaultdict
+import time
+import threading
+from contextlib import closing, contextmanager
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 
 from langchain_utils import OpenWeatherMapAPIWrapper, LLAMA2
+from execution_utils import (
+    plan_batches,
+    plan_dependencies,
+    run_dependency_graph,
+    MERGED_PARAMETERS,
+    REMOVING_FUNCTIONS,
+    RESOLVED_PARAMETERS,
+)
+from todocli_utils import (
+    run_todo_command,
+    get_last_task_id,
+    read_tasks_data,
+    check_todo_output,
+    TodoCommandError,
+)
+from transaction_utils import (
+    snapshot_data_dir,
+    restore_data_dir,
+    get_execution_journal,
+)
+from search_utils import TaskTitleIndex
+from classifier_utils import weather_check_classifier
+from signature_utils import SignatureRegistry
+from parsing_utils import (
+    strip_ansi,
+    fix_json_literals,
+    standardize_date_format,
+    parse_tasks_data,
+    lines_of,
+)
 
-from langchain.agents import AgentExecutor, Tool, create_json_chat_agent
-from langchain.prompts.prompt import PromptTemplate
-
-import numpy as np
+# langchain.agents is imported where it's used, it makes up most of this
+# module's import time.
 
 from app_utils import get_user_confirmation, set_raw_llm_response
 
@@ -25,32 +56,93 @@ logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
     handlers=[
-        logging.FileHandler("debug.log"),
+        logging.FileHandler("debug.log", delay=True),
         # logging.StreamHandler()
     ],
 )
 
-OPENWEATHERMAP_API_KEY = os.environ["OPENWEATHERMAP_API_KEY"]
 execution_queue = []
 confirmation_mechanism_enabled = True
+# Skip the weather agent for instructions without a date, outdoor activity or place.
+weather_preclassifier_enabled = True
+# "subprocess" runs every command through `bash -c`, "inprocess" runs todocli
+# in one long-lived worker process.
+TODO_BACKEND = os.environ.get("TODO_BACKEND", "subprocess")
+# "sqlite" reads the tasks snapshot from todocli's database, "cli" scrapes the
+# output of `todo search` and `todo history`.
+TASKS_DATA_SOURCE = os.environ.get("TASKS_DATA_SOURCE", "sqlite")
+# Set while a thread runs a batch of commands in one todocli session.
+todo_session_state = threading.local()
+
+# Snapshot of get_tasks_data, keyed on the todocli database file's stat.
+tasks_data_cache = {"key": None, "data": None}
+tasks_data_cache_lock = threading.Lock()
+todo_data_dir = None
+# Trigram index over the snapshot's titles, kept up to date by our own mutations.
+title_index = {"key": None, "index": None}
+title_index_lock = threading.Lock()
+# The todo commands changing tasks that are running, and how many started so
+# far. A mutation that overlapped another can't patch the index.
+mutation_state = {"running": 0, "started": 0}
+mutation_lock = threading.Lock()
+# Runs the independent stages of student_llm (weather agent, tasks snapshot).
+stage_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="student_llm")
+# Runs the batches of execute_commands that don't depend on each other.
+command_executor = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="execute_commands"
+)
+# Apply every plan completely or not at all, and a retried plan only once.
+transactional_execution_enabled = True
+# Kept in the todocli data directory, so resetting todocli clears it as well.
+EXECUTION_JOURNAL_FILE = "execution_journal.sqlite"
+# Transactions run one at a time, a rollback must not undo another's commands.
+transaction_lock = threading.Lock()
+# LLM and weather agent shared by every request, rebuilt when the template changes.
+AGENT_PROMPT_TEMPLATE_FILE = "./agent_prompt_template.txt"
+agent_pipeline = {"key": None, "llm": None, "agent_executor": None}
+agent_pipeline_lock = threading.Lock()
+
+BASE_PROMPT_FILE = "./base_prompt.txt"
+base_prompt = None
+
+
+def get_base_prompt():
+    global base_prompt
+    if base_prompt is None:
+        with open(BASE_PROMPT_FILE, "r") as f:
+            base_prompt = f.read()
+    return base_prompt
+
 
-with open("./base_prompt.txt", "r") as f:
-    BASE_PROMPT = f.read()
+def __getattr__(name):
+    # BASE_PROMPT used to be read at import time.
+    if name == "BASE_PROMPT":
+        return get_base_prompt()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def process_bash_output(o):
     # Remove ANSI escape characters
-    ansi_escape_pattern = re.compile(r"\x1B[@-_][0-?]*[ -/]*[@-~]")
-    o = ansi_escape_pattern.sub("", o)
-    return o
+    return strip_ansi(o)
 
 
 def log_and_exec_process(command, func_name):
     logging.info(f"running command: {command}")
 
-    p = subprocess.run(["bash", "-c", command], capture_output=True, text=True)
+    check = getattr(todo_session_state, "check", False)
+    if TODO_BACKEND == "inprocess" or getattr(todo_session_state, "active", False):
+        stdout = run_todo_command(command, check=check)
+    else:
+        p = subprocess.run(["bash", "-c", command], capture_output=True, text=True)
+        stdout = p.stdout
+        if check and p.returncode:
+            raise TodoCommandError(
+                f"{command!r} exited with {p.returncode}: {p.stderr.strip()}"
+            )
     # logging.info(f"{func_name} finished")
-    output = process_bash_output(p.stdout)
+    output = process_bash_output(stdout)
+    if check:
+        check_todo_output(command, output)
     if output:
         logging.info(
             f"command output:\n-----\n{output}\n-----",
@@ -58,63 +150,181 @@ def log_and_exec_process(command, func_name):
         return output
 
 
+def stream_process_lines(command):
+    """
+    Yield the lines a todo command prints, without ANSI escapes, as it prints them.
+
+    With the subprocess backend the lines are read from the pipe, so the
+    whole output is never held at once. In-process commands return their
+    output as a whole and are split afterwards.
+    """
+    logging.info(f"running command: {command}")
+
+    if TODO_BACKEND == "inprocess" or getattr(todo_session_state, "active", False):
+        yield from lines_of(process_bash_output(run_todo_command(command)))
+        return
+    with subprocess.Popen(
+        ["bash", "-c", command],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    ) as p:
+        for line in p.stdout:
+            yield process_bash_output(line)
+
+
+@contextmanager
+def todo_session():
+    # Run the commands of this thread in the todocli worker process instead of
+    # spawning a process for each of them.
+    previous = getattr(todo_session_state, "active", False)
+    todo_session_state.active = True
+    try:
+        yield
+    finally:
+        todo_session_state.active = previous
+
+
+@contextmanager
+def checked_commands():
+    # Make the commands of this thread raise TodoCommandError when todocli fails.
+    previous = getattr(todo_session_state, "check", False)
+    todo_session_state.check = True
+    try:
+        yield
+    finally:
+        todo_session_state.check = previous
+
+
+def get_todo_data_dir():
+    # The data directory doesn't move during the lifetime of the process.
+    global todo_data_dir
+    if todo_data_dir is None:
+        todo_data_dir = todo_location().strip()
+    return todo_data_dir
+
+
+def get_tasks_data_key():
+    data_dir = get_todo_data_dir()
+    try:
+        stat = os.stat(os.path.join(data_dir, "data.sqlite"))
+    except FileNotFoundError:
+        return (data_dir, None, None)
+    return (data_dir, stat.st_mtime_ns, stat.st_size)
+
+
+def invalidate_tasks_data():
+    with tasks_data_cache_lock:
+        tasks_data_cache["key"] = None
+        tasks_data_cache["data"] = None
+
+
 def get_tasks_data():
-    tasks_data = defaultdict(dict)
-    tasks_flat_list = ""
-    temp_str = todo_search("", is_done=False)
-    if temp_str:
-        tasks_flat_list += temp_str
-    temp_str = todo_search("", is_done=True)
-    if temp_str:
-        tasks_flat_list += temp_str
-    tasks_history = todo_history()
-
-    # Parse todo search output
-    pattern = re.compile(
-        # r"^\s(\w+)\s+\|\s+([^★#]+)(?:★(\d+))?\s?(?:#(\w+))?",
-        r"^\s(\w+)\s+\|\s+(\[DONE\])?([^★#\U0000231b\n]+)(?:\U0000231b[^★#]+)?(?:★(\d+))?\s?(?:#(\w+))?",
-        re.MULTILINE,
-    )
-    for i, match in enumerate(pattern.finditer(tasks_flat_list)):
-        id = match.group(1)
-        tasks_data[id]["sort_by"] = i
-        tasks_data[id]["priority"] = match.group(4)
-        tasks_data[id]["context"] = match.group(5)
-        tasks_data[id]["title"] = match.group(3).strip()
-
-    # Parse todo --history output
-    lines = tasks_history.strip().split("\n")
-    if not lines == ["No history."]:
-        header_line = lines[1]  ## This line contains the dashes under the headers
-        ## Find all start and end indices of '-' sections to determine column boundaries
-        field_bounds = []
-        last_pos = 0
-        while True:
-            start = header_line.find("-", last_pos)
-            if start == -1:
-                break
-            end = header_line.find(" ", start)
-            if end == -1:
-                end = len(header_line)
-            field_bounds.append((start, end))
-            last_pos = end
-
-        ## Parse each data line using the detected field boundaries
-        for line in lines[2:]:  # Skip headers and dashes line
-            id = line[field_bounds[0][0] : field_bounds[0][1]].strip()
-            # tasks_data[id]["created"] = line[
-            #     field_bounds[2][0] : field_bounds[2][1]
-            # ].strip()
-            if len(field_bounds) > 4:
-                tasks_data[id]["status"] = line[
-                    field_bounds[4][0] : field_bounds[4][1]
-                ].strip()
-            if not tasks_data[id]["status"]:
-                tasks_data[id]["status"] = "UNDONE"
-
-    # Format the result
-    tasks_data = [{"id": key, **value} for key, value in tasks_data.items()]
-    return json.dumps(tasks_data)
+    # Serve the snapshot from the cache as long as the database file is untouched.
+    key = get_tasks_data_key()
+    with tasks_data_cache_lock:
+        if key[1] is not None and tasks_data_cache["key"] == key:
+            return tasks_data_cache["data"]
+
+    data = fetch_tasks_data()
+    ## Only cache if nothing changed the database while we were reading it.
+    if get_tasks_data_key() == key:
+        with tasks_data_cache_lock:
+            tasks_data_cache["key"] = key
+            tasks_data_cache["data"] = data
+    return data
+
+
+def invalidate_title_index():
+    with title_index_lock:
+        title_index["key"] = None
+        title_index["index"] = None
+
+
+def get_title_index():
+    key = get_tasks_data_key()
+    with title_index_lock:
+        if title_index["index"] is not None and title_index["key"] == key:
+            return title_index["index"]
+
+    data = json.loads(get_tasks_data())
+    index = TaskTitleIndex((task["id"], task.get("title", "")) for task in data)
+    ## Like the snapshot, only keep it if nothing changed the database meanwhile.
+    if get_tasks_data_key() == key:
+        with title_index_lock:
+            title_index["key"] = key
+            title_index["index"] = index
+    return index
+
+
+def update_title_index(key, update=None):
+    # Apply one of our own mutations to the index instead of rebuilding it. Only
+    # valid if the index matched the database right before the mutation.
+    new_key = get_tasks_data_key()
+    if new_key == key:
+        return
+    with title_index_lock:
+        if title_index["index"] is None or title_index["key"] != key:
+            return
+        if update:
+            update(title_index["index"])
+        title_index["key"] = new_key
+
+
+def run_mutation(command, func_name, update=False):
+    """
+    Run a todo command that changes tasks, and keep the title index up to date.
+
+    Mutations run concurrently. When another one ran at the same time, the
+    database key read before the command doesn't tell which changes the index
+    misses, so it's dropped and rebuilt on its next use instead of patched.
+
+    Parameters:
+        command (str): The todo command.
+        func_name (str): The calling todo function, for the log.
+        update (callable or bool, optional): Applies the change to the title index. True if no title changed, False (the default) to rebuild the index.
+
+    Returns:
+        str: The command's output, as `log_and_exec_process` returns it.
+    """
+    with mutation_lock:
+        overlapped = mutation_state["running"] > 0
+        mutation_state["running"] += 1
+        mutation_state["started"] += 1
+        started = mutation_state["started"]
+        key = get_tasks_data_key()
+    succeeded = False
+    try:
+        result = log_and_exec_process(command, func_name)
+        succeeded = True
+    finally:
+        invalidate_tasks_data()
+        with mutation_lock:
+            mutation_state["running"] -= 1
+            overlapped |= mutation_state["started"] != started
+            if not succeeded or overlapped or update is False:
+                invalidate_title_index()
+            else:
+                update_title_index(key, None if update is True else update)
+    return result
+
+
+def fetch_tasks_data():
+    if TASKS_DATA_SOURCE == "sqlite":
+        try:
+            return read_tasks_data(get_todo_data_dir())
+        except (sqlite3.Error, FileNotFoundError) as e:
+            logging.warning(f"Reading the todocli database failed ({e}), using todocli")
+    return scrape_tasks_data()
+
+
+def scrape_tasks_data():
+    # The same commands as todo_search("", ...) and todo_history(), parsed
+    # while todocli prints them.
+    undone = stream_process_lines("todo search '' --undone")
+    done = stream_process_lines("todo search '' --done")
+    tasks_history = stream_process_lines("todo history")
+    return parse_tasks_data(chain(undone, done), tasks_history)
 
 
 def todo_list(context="", flat=False, tidy=False):
@@ -183,7 +393,11 @@ def todo_add(
     if front:
         command += " --front"
 
-    log_and_exec_process(command, "todo_add")
+    run_mutation(
+        command,
+        "todo_add",
+        lambda index: index.add(get_last_task_id(get_todo_data_dir()), title),
+    )
 
 
 def todo_mark_as_done(ids):
@@ -201,14 +415,15 @@ def todo_mark_as_done(ids):
     # Convert a single string into a list with lenght one.
     if type(ids) == str:
         ids = [ids]
-    for task_name in ids:
-        task_id = get_task_id(task_name)
-        if task_id:
-            ids_int.append(str(task_id))
+    resolved = get_task_ids(ids)
+    log_unresolved_task_ids(resolved)
+    for item in resolved:
+        if item["id"] and item["id"] not in ids_int:
+            ids_int.append(item["id"])
     if ids_int:
         command = f"todo done {' '.join(ids_int)}"
 
-        log_and_exec_process(command, "todo_mark_as_done")
+        run_mutation(command, "todo_mark_as_done", update=True)
 
 
 def todo_task(
@@ -261,7 +476,13 @@ def todo_task(
     if front is not None:
         command += f" --front {'true' if front else 'false'}"
 
-    return log_and_exec_process(command, "todo_task")
+    result = run_mutation(
+        command,
+        "todo_task",
+        (lambda index: index.rename(id, title)) if title else True,
+    )
+
+    return result
 
 
 def todo_history():
@@ -326,14 +547,19 @@ def todo_rm(ids):
     # Convert a single string into a list with lenght one.
     if type(ids) == str:
         ids = [ids]
-    for task_name in ids:
-        task_id = get_task_id(task_name)
-        if task_id:
-            ids_int.append(str(task_id))
+    resolved = get_task_ids(ids)
+    log_unresolved_task_ids(resolved)
+    for item in resolved:
+        if item["id"] and item["id"] not in ids_int:
+            ids_int.append(item["id"])
     if ids_int:
         command = f"todo rm {' '.join(ids_int)}"
 
-        log_and_exec_process(command, "todo_rm")
+        def remove_from_index(index):
+            for task_id in ids_int:
+                index.remove(task_id)
+
+        run_mutation(command, "todo_rm", remove_from_index)
 
 
 def todo_ping(ids):
@@ -348,7 +574,7 @@ def todo_ping(ids):
     """
     command = f"todo ping {' '.join(ids)}"
 
-    log_and_exec_process(command, "todo_ping")
+    run_mutation(command, "todo_ping")
 
 
 def todo_purge(force=False, before=None):
@@ -368,7 +594,7 @@ def todo_purge(force=False, before=None):
     if before:
         command += f" --before {before}"
 
-    log_and_exec_process(command, "todo_purge")
+    run_mutation(command, "todo_purge")
 
 
 def todo_edit_ctx(
@@ -398,7 +624,7 @@ def todo_edit_ctx(
     if name:
         command += f" --name '{name}'"
 
-    log_and_exec_process(command, "todo_edit_ctx")
+    run_mutation(command, "todo_edit_ctx")
 
 
 def todo_mv(source_ctx, destination_ctx):
@@ -414,7 +640,7 @@ def todo_mv(source_ctx, destination_ctx):
     """
     command = f"todo mv '{source_ctx}' '{destination_ctx}'"
 
-    log_and_exec_process(command, "todo_mv")
+    run_mutation(command, "todo_mv")
 
 
 def todo_rmctx(context, force=True):
@@ -432,7 +658,7 @@ def todo_rmctx(context, force=True):
     if force:
         command += " --force"
 
-    log_and_exec_process(command, "todo_rmctx")
+    run_mutation(command, "todo_rmctx")
 
 
 def todo_future():
@@ -482,105 +708,345 @@ functions_dict = {
     "todo_search": todo_search,
     "todo_task": todo_task,
 }
+# Other names the LLM uses for the parameters of the functions above.
+PARAMETER_ALIASES = {
+    "ids": ["id", "task_id", "task_ids", "tasks"],
+    "id": ["task_id", "ids"],
+    "title": ["name", "task", "task_name", "new_title"],
+    "context": ["ctx", "list", "context_name", "category"],
+    "deadline": ["due", "due_date", "end", "end_date"],
+    "start": ["start_date", "begin"],
+    "priority": ["importance", "prio"],
+    "depends_on": ["dependencies", "depends", "dependency"],
+    "period": ["recurrence", "repeat", "interval"],
+    "source_ctx": ["source", "from_ctx", "source_context"],
+    "destination_ctx": ["destination", "to_ctx", "destination_context", "target"],
+    "term": ["query", "search", "keyword", "search_term"],
+    "is_done": ["done", "include_done"],
+    "name": ["new_name"],
+}
+signature_registry = SignatureRegistry(functions_dict, PARAMETER_ALIASES)
 
 
-def empty_execution_queue():
-    global execution_queue
-    execution_queue = []
+CONFIRMATION_MESSAGE = "It seems your are going to participate in an outdoor activity and the weather condition is not suitable. I recommend to reschedule your task. Are you sure you want to add the task anyway?"
 
 
-def parse_llm_output_and_populate_commands(text):
-    global functions_dict
-    global execution_queue
-    execution_queue = []
+def parse_llm_output(text):
+    """
+    Turn the <JSON> block of an LLM response into queued function calls.
+
+    Returns:
+        tuple: (queue, confirmation_needed), the queue being a list of (func, func_params, log) entries. A response without a <JSON> block gives an empty queue.
+    """
     try:
         processed = text.split("<JSON>")[1].split("</JSON>")[0].strip()
     except Exception as e:
         logging.info("Bad LLM response structure.")
-        return
+        return [], False
 
     # correct some common mistakes in json formatting
-    # Replace 'True' with 'true' and 'False' with 'false'
-    processed = re.sub(r"\bTrue\b", "true", processed)
-    processed = re.sub(r"\bFalse\b", "false", processed)
-
-    # Replace "None" with "null"
-    processed = re.sub(r"None", "null", processed)
+    processed = fix_json_literals(processed)
 
     # changes the formatting of datetime to the specified format
     processed = standardize_date_format(processed)
     processed = json.loads(processed)
 
+    queue = []
     confirmation_needed = False
-    confirmation_message = "It seems your are going to participate in an outdoor activity and the weather condition is not suitable. I recommend to reschedule your task. Are you sure you want to add the task anyway?"
-
     for f in processed:
         func = (
             functions_dict[f["function"]] if f["function"] in functions_dict else None
         )
         if func:
-            llm_named_args = list(f["parameters"].keys())
-            actual_named_args = inspect.getfullargspec(func).args
-            matching = string_matcher(llm_named_args, actual_named_args)
-            func_params = {matching[k]: val for k, val in f["parameters"].items()}
+            func_params = signature_registry.match(f["function"], f["parameters"])
             if "ask_confirmation" in func_params and func_params["ask_confirmation"]:
                 confirmation_needed = True
                 # confirmation_message += f["log"] + "\n"
-            execution_queue.append((func, func_params, f.get("log", "")))
-
-    if confirmation_needed and confirmation_mechanism_enabled:
-        # first callback: confiremd, second callback: not confirmed
-        # second callback can be discarded, but emptying execution queue won't hurt.
-        get_user_confirmation(
-            message=confirmation_message,
-            callbacks=(execute_commands, empty_execution_queue),
-        )
+            queue.append((func, func_params, f.get("log", "")))
+    return queue, confirmation_needed
+
+
+class ExecutionSession:
+    """
+    The execution state of one user: the calls queued from their last LLM
+    response, and whether to ask them for confirmation before running them.
+
+    Every Streamlit session (or other client) gets its own, so concurrent
+    users can't run or drop each other's plans. The methods are thread-safe.
+    """
+
+    def __init__(self, confirmation_enabled=True, confirm=None):
+        """
+        Parameters:
+            confirmation_enabled (bool, optional): Whether to ask before running a plan that needs confirmation. Defaults to True.
+            confirm (callable, optional): Called with `message` and `callbacks` (run, cancel) to ask for confirmation. Defaults to app_utils.get_user_confirmation.
+        """
+        self.lock = threading.RLock()
+        self.queue = []
+        # The calls of the last response, for showing them to the user.
+        self.plan = []
+        self.confirmation_enabled = confirmation_enabled
+        self.confirm = confirm
+
+    def populate(self, text):
+        """
+        Queue the calls of an LLM response, replacing the queued ones.
+
+        Returns:
+            bool: Whether the user was asked for confirmation, in which case the calls run once they confirm.
+        """
+        with self.lock:
+            self.queue = []
+            self.queue, confirmation_needed = parse_llm_output(text)
+            self.plan = [
+                {"function": func.__name__, "parameters": func_params, "log": log}
+                for func, func_params, log in self.queue
+            ]
+            confirmation_enabled = self.confirmation_enabled
+
+        if confirmation_needed and confirmation_enabled:
+            # first callback: confiremd, second callback: not confirmed
+            # second callback can be discarded, but emptying execution queue won't hurt.
+            (self.confirm or get_user_confirmation)(
+                message=CONFIRMATION_MESSAGE,
+                callbacks=(self.execute, self.cancel),
+            )
+            return True
+        return False
+
+    def execute(self, request_key=None):
+        """
+        Run the queued calls and empty the queue.
 
-    return
+        Returns:
+            bool: Whether anything was applied.
+        """
+        ## Take the queue, so a second confirmation can't run it again.
+        with self.lock:
+            queue, self.queue = self.queue, []
+        if not queue:
+            return False
+        if transactional_execution_enabled:
+            return execute_transaction(queue, request_key)
+        execute_plan(queue)
+        return True
 
+    def cancel(self):
+        with self.lock:
+            self.queue = []
 
-def execute_commands():
-    global execution_queue
-    if execution_queue:
-        for func, func_params, log in execution_queue:
-            logging.info(log)
-            output = func(**func_params)
 
+class ModuleExecutionSession(ExecutionSession):
+    # The session of the callers that don't pass one. Its state lives in the
+    # module globals execution_queue and confirmation_mechanism_enabled.
 
-def string_matcher(list_a, list_b):
-    similarities = np.zeros((len(list_a), len(list_b)))
-    for i, item_a in enumerate(list_a):
-        for j, item_b in enumerate(list_b):
-            similarities[i, j] = SequenceMatcher(None, item_a, item_b).ratio()
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.plan = []
+        self.confirm = None
 
-    similarities_agg = np.argmax(similarities, 1)
-    return {item_a: list_b[similarities_agg[i]] for i, item_a in enumerate(list_a)}
+    @property
+    def queue(self):
+        return execution_queue
+
+    @queue.setter
+    def queue(self, queue):
+        global execution_queue
+        execution_queue = queue
+
+    @property
+    def confirmation_enabled(self):
+        return confirmation_mechanism_enabled
+
+
+default_session = ModuleExecutionSession()
+
+
+def empty_execution_queue(session=None):
+    (session or default_session).cancel()
+
+
+def parse_llm_output_and_populate_commands(text, session=None):
+    return (session or default_session).populate(text)
+
+
+def execute_commands(request_key=None, session=None):
+    return (session or default_session).execute(request_key)
+
+
+def execute_plan(queue, check=False):
+    batches = plan_batches(queue)
+    dependencies = plan_dependencies(batches, resolve_task_names)
+    logging.info(f"execution plan: {list(zip(batches, dependencies))}")
+    run = execute_checked_batch if check else execute_batch
+    run_dependency_graph(batches, dependencies, run, command_executor)
+
+
+def execute_transaction(queue, request_key=None):
+    """
+    Apply the queued calls as one transaction.
+
+    The todocli data directory is copied before the first command. If a call
+    raises or a todo command exits with an error, the copy is restored and
+    the exception is raised again. With a request key, the request is
+    recorded in the execution journal once committed, and no plan for the
+    same request is applied after that.
+
+    Parameters:
+        queue (list of tuple): (func, func_params, log) entries, as in `execution_queue`.
+        request_key (str, optional): Identifies the request the plan answers, e.g. an Idempotency-Key. Without it the plan is always applied.
+
+    Returns:
+        bool: Whether the plan was applied, False when the request already had been.
+    """
+    data_dir = get_todo_data_dir()
+    with transaction_lock:
+        os.makedirs(data_dir, exist_ok=True)
+        journal = None
+        ## Only a caller's key tells a retry apart from the same instruction given again.
+        if request_key is not None:
+            journal = get_request_journal()
+            if journal.get(request_key) is not None:
+                logging.info(f"request {request_key} was already applied, skipping it")
+                return False
+
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            snapshot_data_dir(data_dir, snapshot_dir)
+            try:
+                execute_plan(queue, check=True)
+            except Exception:
+                logging.exception("plan failed, rolling back")
+                restore_data_dir(snapshot_dir, data_dir)
+                invalidate_tasks_data()
+                invalidate_title_index()
+                raise
+        if journal is not None:
+            journal.record(request_key, {"status": "applied", "commands": len(queue)})
+        return True
+
+
+def get_request_journal():
+    data_dir = get_todo_data_dir()
+    os.makedirs(data_dir, exist_ok=True)
+    return get_execution_journal(os.path.join(data_dir, EXECUTION_JOURNAL_FILE))
+
+
+def execute_checked_batch(batch):
+    with checked_commands():
+        execute_batch(batch)
+
+
+def resolve_task_names(task_names):
+    # The IDs of all the tasks each name may refer to, in one snapshot.
+    index = get_title_index()
+    return [{name} if name in index else set(index.find(name)) for name in task_names]
+
+
+def execute_batch(batch):
+    for log in batch.logs:
+        logging.info(log)
+
+    if batch.kind == "merge":
+        ids = merged_task_ids(batch)
+        if ids:
+            batch.func(**{MERGED_PARAMETERS[batch.func.__name__]: ids})
+    elif batch.kind == "session":
+        with todo_session():
+            for func, func_params, _ in batch.calls:
+                func(**func_params)
+    elif batch.kind == "resolve":
+        ## One snapshot for the names of the whole batch, names that don't
+        ## resolve are left for the function to report.
+        param = RESOLVED_PARAMETERS[batch.func.__name__]
+        resolved = get_task_ids(
+            [func_params.get(param) for _, func_params, _ in batch.calls]
+        )
+        for (func, func_params, _), item in zip(batch.calls, resolved):
+            if item["id"]:
+                func_params = {**func_params, param: item["id"]}
+            func(**func_params)
+    else:
+        for func, func_params, _ in batch.calls:
+            func(**func_params)
+
+
+def merged_task_ids(batch):
+    # Resolve every call's names as if the calls before it had already run:
+    # the tasks they removed no longer match.
+    removed = set()
+    ids = []
+    for names in batch.call_names():
+        resolved = get_task_ids(names, exclude=removed)
+        log_unresolved_task_ids(resolved)
+        found = [item["id"] for item in resolved if item["id"]]
+        ids += found
+        if batch.func.__name__ in REMOVING_FUNCTIONS:
+            removed.update(found)
+    return list(dict.fromkeys(ids))
 
 
 def get_task_id(task_name):
     # Fetch the ID of the corresponding task_name
     ## if task_name is identical to an ID, it is treated as an ID, else I'll search the task names for it.
-    task_name = str(task_name)
-    data = json.loads(get_tasks_data())
-    if data:
-        ids, names = zip(
-            *[(task["id"], task["title"]) for task in data]
-        )
-    else:
-        ids, names = [], []
+    (item,) = get_task_ids([task_name])
+    log_unresolved_task_ids([item])
+    return item["id"] or False
 
-    if task_name in ids:
-        return task_name
 
-    found_names = [task for task in names if task_name.lower() in task.lower()]
-    if len(found_names) > 1:
-        logging.info("multiple tasks found!")
-        return False
-    elif len(found_names) == 0:
-        logging.info(f"no tasks found searching for {task_name}!")
-        return False
-    else:
-        return ids[names.index(found_names[0])].strip()
+def get_task_ids(task_names, exclude=()):
+    """
+    Resolve several task names to task IDs using the trigram index of task titles.
+
+    Parameters:
+        task_names (list of str): Task IDs or parts of task titles. A name identical to an existing ID is treated as that ID.
+        exclude (collection of str, optional): IDs of tasks to treat as if they didn't exist.
+
+    Returns:
+        list of dict: One entry per name, in the given order, with the keys "name", "id" (None unless exactly one task matched), "status" ("found", "ambiguous" or "missing"), "matches" (IDs of all matching tasks) and "candidates" (IDs of the closest titles when nothing matched).
+    """
+    task_names = [str(task_name) for task_name in task_names]
+    index = get_title_index()
+
+    resolved = []
+    for name in task_names:
+        if name in index and name not in exclude:
+            found = [name]
+        else:
+            found = [id for id in index.find(name) if id not in exclude]
+        status = "found" if len(found) == 1 else "ambiguous" if found else "missing"
+        resolved.append(
+            {
+                "name": name,
+                "id": found[0] if status == "found" else None,
+                "status": status,
+                "matches": found,
+                "candidates": (
+                    [id for id in index.rank(name) if id not in exclude]
+                    if status == "missing"
+                    else []
+                ),
+            }
+        )
+    return resolved
+
+
+def log_unresolved_task_ids(resolved):
+    # Under checked_commands a name that doesn't name exactly one task fails
+    # the command, instead of the command leaving that task out.
+    unresolved = []
+    for item in resolved:
+        if item["status"] == "ambiguous":
+            logging.info(
+                f"multiple tasks found searching for {item['name']}: {', '.join(item['matches'])}!"
+            )
+            unresolved.append(f"{item['name']!r} is ambiguous")
+        elif item["status"] == "missing":
+            logging.info(
+                f"no tasks found searching for {item['name']}! closest: {', '.join(item['candidates'])}"
+            )
+            unresolved.append(f"{item['name']!r} matches no task")
+    if unresolved and getattr(todo_session_state, "check", False):
+        raise TodoCommandError(", ".join(unresolved))
 
 
 def reset_todocli():
@@ -588,48 +1054,41 @@ def reset_todocli():
     if Path.exists(Path(todo_loc)):
         shutil.rmtree(todo_loc)
         logging.info(f"removed {todo_loc}")
+    invalidate_tasks_data()
 
 
-def standardize_date_format(text):
-    # Define a regex pattern to match dates in MM/DD/YYYY, DD-MM-YYYY, YYYY/MM/DD formats, etc.
-    # This pattern also matches optional time in HH:MM:SS format after the date.
-    date_pattern = re.compile(
-        r"(?P<year>\d{4})[/-](?P<month>\d{1,2})[/-](?P<day>\d{1,2})|"  # Matches YYYY-MM-DD and variants
-        r"(?P<month2>\d{1,2})[/-](?P<day2>\d{1,2})[/-](?P<year2>\d{4})|"  # Matches MM/DD/YYYY and variants
-        r"(?P<day3>\d{1,2})[/-](?P<month3>\d{1,2})[/-](?P<year3>\d{4})"  # Matches DD-MM-YYYY and variants
-        r"(?:\s+(?P<hours>\d{1,2}):(?P<minutes>\d{2}):(?P<seconds>\d{2}))?",  # Optional time
-        re.VERBOSE,
-    )
-
-    def replace_with_standard_format(match):
-        # Extract date components from the match object
-        year = match.group("year") or match.group("year2") or match.group("year3")
-        month = match.group("month") or match.group("month2") or match.group("month3")
-        day = match.group("day") or match.group("day2") or match.group("day3")
-        hours = match.group("hours")
-        minutes = match.group("minutes")
-        seconds = match.group("seconds")
-
-        # Format month and day to ensure two digits
-        month = f"{int(month):02d}"
-        day = f"{int(day):02d}"
-
-        # Construct the standard date format
-        standard_date = f"{year}-{month}-{day}"
-        if hours and minutes and seconds:
-            return f"{standard_date} {hours}:{minutes}:{seconds}"
-        else:
-            return standard_date
-
-    # Replace all found dates with the standard format
-    return date_pattern.sub(replace_with_standard_format, text)
+def stream_json_block(llm, prompt):
+    """
+    Stream a generation and stop reading it once the <JSON> block is complete.
 
+    Parameters:
+        llm (LLAMA2): The model to stream from.
+        prompt (str): The prompt to send.
 
-def student_llm(input_prompt, cleanup=False):
-    if cleanup:
-        reset_todocli()
+    Returns:
+        str: The generated text up to and including "</JSON>", or the whole generation if it has no JSON block.
+    """
+    response = ""
+    with closing(llm.stream(prompt)) as chunks:
+        for chunk in chunks:
+            response += chunk
+            start = response.find("<JSON>")
+            end = response.find("</JSON>", start) if start != -1 else -1
+            if end != -1:
+                logging.info("JSON block complete, closing the LLM stream early.")
+                return response[: end + len("</JSON>")]
+    return response
+
+
+def build_agent_pipeline():
+    """
+    Build the LLM and the weather agent executor used by student_llm.
 
-    logging.info("-----Request Start-----")
+    Returns:
+        tuple: The LLAMA2 instance and the AgentExecutor wrapping it.
+    """
+    from langchain.agents import AgentExecutor, Tool, create_json_chat_agent
+    from langchain.prompts.prompt import PromptTemplate
 
     llm = LLAMA2()
 
@@ -644,30 +1103,113 @@ def student_llm(input_prompt, cleanup=False):
                         It is based on your judgement whether an activity belongs to outdoor activities.""",
         ),
     ]
-    with open("./agent_prompt_template.txt", "r") as f:
+    with open(AGENT_PROMPT_TEMPLATE_FILE, "r") as f:
         agent_prompt_template = f.read()
     agent_prompt = PromptTemplate.from_template(agent_prompt_template)
     agent = create_json_chat_agent(llm, tools, agent_prompt)
     agent_executor = AgentExecutor(
         agent=agent, tools=tools, verbose=True, handle_parsing_errors=False
     )
+    return llm, agent_executor
+
+
+def get_agent_pipeline():
+    """
+    Return the shared (llm, agent_executor) pair, building it on first use.
+
+    The pipeline is stateless between invocations, so Streamlit sessions share
+    it. It's rebuilt if the agent prompt template file is modified.
+    """
+    stat = os.stat(AGENT_PROMPT_TEMPLATE_FILE)
+    key = (AGENT_PROMPT_TEMPLATE_FILE, stat.st_mtime_ns, stat.st_size)
+    with agent_pipeline_lock:
+        if agent_pipeline["key"] != key:
+            logging.info("Building the agent pipeline.")
+            llm, agent_executor = build_agent_pipeline()
+            agent_pipeline.update(key=key, llm=llm, agent_executor=agent_executor)
+        return agent_pipeline["llm"], agent_pipeline["agent_executor"]
+
+
+def run_weather_agent(agent_executor, input_prompt):
+    if weather_preclassifier_enabled and not (
+        weather_check_classifier.needs_weather_check(input_prompt)
+    ):
+        # What the agent answers when it has no tool to use.
+        return ""
     result = agent_executor.invoke({"input": input_prompt})
-    agent_output = result["output"]
+    return result["output"]
+
+
+def timed_stage(timings, name, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def log_stage_timings(timings):
+    parallel = ("weather_agent", "tasks_data")
+    critical = max(parallel, key=lambda name: timings.get(name, 0))
+    logging.info(
+        "stage timings: "
+        + ", ".join(
+            f"{name}={seconds * 1000:.1f}ms" for name, seconds in timings.items()
+        )
+        + f", critical path: {critical}"
+    )
+
+
+def student_llm(input_prompt, cleanup=False, session=None, request_key=None):
+    if cleanup:
+        reset_todocli()
+
+    ## A retried request isn't planned again, the LLM may plan it differently.
+    if request_key is not None and get_request_journal().get(request_key):
+        logging.info(f"request {request_key} was already applied, skipping it")
+        return False
+
+    logging.info("-----Request Start-----")
+    timings = {}
+
+    llm, agent_executor = timed_stage(timings, "pipeline", get_agent_pipeline)
+    # The weather report and the tasks snapshot don't depend on each other.
+    agent_future = stage_executor.submit(
+        timed_stage,
+        timings,
+        "weather_agent",
+        run_weather_agent,
+        agent_executor,
+        input_prompt,
+    )
+    tasks_future = stage_executor.submit(
+        timed_stage, timings, "tasks_data", get_tasks_data
+    )
+    tasks_data = tasks_future.result()
+    agent_output = agent_future.result()
 
     ## Task Manager
     USER_PROMPT = (
         "here is the list of my current tasks in JSON format:\n"
-        + f"{get_tasks_data()}\n"
+        + f"{tasks_data}\n"
         + f"instruction: {input_prompt}\n"
         + f"<<weather check report>>: {agent_output}"
     )
     logging.info(f"\nuser prompt:\n-----{USER_PROMPT}\n-----")
-    FULL_PROMPT = BASE_PROMPT + f"\nUSER: {USER_PROMPT}\n"
-    response = llm.invoke(FULL_PROMPT)
+    FULL_PROMPT = get_base_prompt() + f"\nUSER: {USER_PROMPT}\n"
+    if llm.streaming:
+        response = timed_stage(
+            timings, "task_manager", stream_json_block, llm, FULL_PROMPT
+        )
+    else:
+        response = timed_stage(timings, "task_manager", llm.invoke, FULL_PROMPT)
+    log_stage_timings(timings)
     set_raw_llm_response(response)
 
     # Execute commands
-    parse_llm_output_and_populate_commands(response)
+    confirmation_asked = parse_llm_output_and_populate_commands(response, session)
     ## Warning:  this part of code and everything after is not guranteed to run. the flow of the program may change in parse_llm_output_and_populate_commands. Reason: streamlit and user confirmation.
-    execute_commands()
-    return
+    ## Clients that don't stop here wait for the confirmation callback.
+    if not confirmation_asked:
+        return execute_commands(request_key, session)
+    return False
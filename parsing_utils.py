@@ -0,0 +1,211 @@
+"""
+Parsers for todocli's output and the LLM's JSON, with their regexes compiled once.
+"""
+
+import io
+import re
+import json
+
+ANSI_ESCAPE_PATTERN = re.compile(r"\x1B[@-_][0-?]*[ -/]*[@-~]")
+
+# One task of `todo search` output: id, [DONE], title, priority and context.
+# Ids are right-aligned, so shorter ones have more than one leading space.
+SEARCH_LINE_PATTERN = re.compile(
+    # r"^\s(\w+)\s+\|\s+([^★#]+)(?:★(\d+))?\s?(?:#(\w+))?",
+    r"^\s+(\w+)\s+\|\s+(\[DONE\])?([^★#\U0000231b\n]+)(?:\U0000231b[^★#]+)?(?:★(\d+))?\s?(?:#(\w+))?",
+    re.MULTILINE,
+)
+# The start of a task in `todo search` output, other lines continue a wrapped title.
+SEARCH_TASK_START_PATTERN = re.compile(r"^\s+(\w+)\s+\|")
+
+# Dates in MM/DD/YYYY, DD-MM-YYYY, YYYY/MM/DD formats, etc.
+# This pattern also matches optional time in HH:MM:SS format after the date.
+DATE_PATTERN = re.compile(
+    r"(?P<year>\d{4})[/-](?P<month>\d{1,2})[/-](?P<day>\d{1,2})|"  # Matches YYYY-MM-DD and variants
+    r"(?P<month2>\d{1,2})[/-](?P<day2>\d{1,2})[/-](?P<year2>\d{4})|"  # Matches MM/DD/YYYY and variants
+    r"(?P<day3>\d{1,2})[/-](?P<month3>\d{1,2})[/-](?P<year3>\d{4})"  # Matches DD-MM-YYYY and variants
+    r"(?:\s+(?P<hours>\d{1,2}):(?P<minutes>\d{2}):(?P<seconds>\d{2}))?",  # Optional time
+    re.VERBOSE,
+)
+
+TRUE_PATTERN = re.compile(r"\bTrue\b")
+FALSE_PATTERN = re.compile(r"\bFalse\b")
+
+
+def strip_ansi(text):
+    return ANSI_ESCAPE_PATTERN.sub("", text)
+
+
+def fix_json_literals(text):
+    # correct some common mistakes in json formatting
+    # Replace 'True' with 'true' and 'False' with 'false'
+    text = TRUE_PATTERN.sub("true", text)
+    text = FALSE_PATTERN.sub("false", text)
+
+    # Replace "None" with "null", anywhere in the text like before
+    return text.replace("None", "null")
+
+
+def replace_with_standard_format(match):
+    # Extract date components from the match object
+    year = match.group("year") or match.group("year2") or match.group("year3")
+    month = match.group("month") or match.group("month2") or match.group("month3")
+    day = match.group("day") or match.group("day2") or match.group("day3")
+    hours = match.group("hours")
+    minutes = match.group("minutes")
+    seconds = match.group("seconds")
+
+    # Format month and day to ensure two digits
+    month = f"{int(month):02d}"
+    day = f"{int(day):02d}"
+
+    # Construct the standard date format
+    standard_date = f"{year}-{month}-{day}"
+    if hours and minutes and seconds:
+        return f"{standard_date} {hours}:{minutes}:{seconds}"
+    else:
+        return standard_date
+
+
+def standardize_date_format(text):
+    # Replace all found dates with the standard format
+    return DATE_PATTERN.sub(replace_with_standard_format, text)
+
+
+class TaskRecord:
+    """One task of the snapshot. Fields stay None until a parser sets them."""
+
+    __slots__ = ("id", "sort_by", "priority", "context", "title", "status")
+
+    def __init__(
+        self, id, sort_by=None, priority=None, context=None, title=None, status=None
+    ):
+        self.id = id
+        self.sort_by = sort_by
+        self.priority = priority
+        self.context = context
+        self.title = title
+        self.status = status
+
+    def to_dict(self):
+        record = {"id": self.id}
+        if self.sort_by is not None:
+            record["sort_by"] = self.sort_by
+            record["priority"] = self.priority
+            record["context"] = self.context
+            record["title"] = self.title
+        if self.status is not None:
+            record["status"] = self.status
+        return record
+
+
+def lines_of(output):
+    # Accept whole outputs as well as line iterators (e.g. a subprocess pipe).
+    return io.StringIO(output) if isinstance(output, str) else output
+
+
+def iter_search_records(lines):
+    """
+    Parse `todo search` output one line at a time.
+
+    Titles todocli wrapped over several lines are joined back together, and
+    the priority and context are read from the end of the last line.
+
+    Parameters:
+        lines (iterable of str): The output's lines, without ANSI escapes.
+
+    Yields:
+        TaskRecord: The tasks in the order they're listed, with sort_by set to that position.
+    """
+    task_lines = iter_task_lines(lines)
+    matches = filter(None, map(SEARCH_LINE_PATTERN.match, task_lines))
+    for sort_by, match in enumerate(matches):
+        yield search_record(match, sort_by)
+
+
+def iter_task_lines(lines):
+    task_line = None
+    for line in lines:
+        line = line.rstrip("\n")
+        if SEARCH_TASK_START_PATTERN.match(line):
+            if task_line is not None:
+                yield task_line
+            task_line = line
+        elif task_line is not None and line.strip():
+            task_line += " " + line.strip()
+    if task_line is not None:
+        yield task_line
+
+
+def search_record(match, sort_by):
+    id, title, priority, context = match.group(1, 3, 4, 5)
+    return TaskRecord(id, sort_by, priority, context, title.strip())
+
+
+def iter_history_statuses(lines):
+    """
+    Parse `todo history` output one line at a time.
+
+    The column boundaries are read from the row of dashes under the headers.
+
+    Yields:
+        tuple: (id, status) of every task, status being "UNDONE" when the column is empty.
+    """
+    lines = iter(lines)
+    header = next(lines, "").strip()
+    if header in ("", "No history."):
+        return
+    ## This line contains the dashes under the headers
+    dashes = next(lines, "").rstrip("\n")
+    field_bounds = [
+        (match.start(), match.end()) for match in re.finditer(r"-+", dashes)
+    ]
+    if not field_bounds:
+        return
+    id_bounds = field_bounds[0]
+    status_bounds = field_bounds[4] if len(field_bounds) > 4 else None
+    for line in lines:
+        if not line.strip():
+            continue
+        id = line[id_bounds[0] : id_bounds[1]].strip()
+        status = ""
+        if status_bounds:
+            status = line[status_bounds[0] : status_bounds[1]].strip()
+        yield id, status or "UNDONE"
+
+
+def parse_tasks_data(search_output, history_output):
+    """
+    Build the tasks snapshot given to the LLM from todocli's output, in a
+    single pass over each output.
+
+    Parameters:
+        search_output (str or iterable of str): `todo search` output of the undone and then the done tasks, without ANSI escapes.
+        history_output (str or iterable of str): `todo history` output, without ANSI escapes.
+
+    Returns:
+        str: JSON list of tasks with their id, sort_by, priority, context, title and status.
+    """
+    records = {}
+    for record in iter_search_records(lines_of(search_output)):
+        # A task listed twice keeps its first place but takes the later fields.
+        records[record.id] = record
+    for id, status in iter_history_statuses(lines_of(history_output)):
+        if id not in records:
+            records[id] = TaskRecord(id)
+        records[id].status = status
+
+    return encode_records(records.values())
+
+
+def encode_records(records, batch_size=1000):
+    # Same text as json.dumps of the whole list, without holding every dict at once.
+    chunks, batch = [], []
+    for record in records:
+        batch.append(record.to_dict())
+        if len(batch) == batch_size:
+            chunks.append(json.dumps(batch)[1:-1])
+            batch = []
+    if batch:
+        chunks.append(json.dumps(batch)[1:-1])
+    return "[" + ", ".join(chunks) + "]"
@@ -0,0 +1,129 @@
+import os
+import sys
+import logging
+import sqlite3
+import threading
+
+# Remaining-call levels at which a warning is logged, once, by whichever
+# process crosses them.
+QUOTA_THRESHOLDS = (1000, 500, 100, 50, 10, 0)
+
+quota_ledgers = {}
+quota_ledgers_lock = threading.Lock()
+
+
+class QuotaLedger:
+    """
+    Counter of remaining AWS API calls, stored in a SQLite database in WAL mode.
+
+    Every decrement is a single IMMEDIATE transaction, so concurrent threads and
+    processes never lose updates and a crash can't leave a truncated file behind.
+    If the ledger is empty it is seeded from the legacy plain-text quota file.
+    """
+
+    def __init__(self, path, seed_file=None, thresholds=QUOTA_THRESHOLDS):
+        self.path = path
+        self.thresholds = thresholds
+        self.listeners = []
+        self.local = threading.local()
+        self.connect().execute("""
+            CREATE TABLE IF NOT EXISTS quota (
+                name TEXT PRIMARY KEY,
+                remaining INTEGER NOT NULL,
+                used INTEGER NOT NULL DEFAULT 0
+            )
+            """)
+        if seed_file and os.path.exists(seed_file):
+            with open(seed_file, "r") as f:
+                remaining = int(f.readlines()[0].strip())
+            self.connect().execute(
+                "INSERT OR IGNORE INTO quota (name, remaining) VALUES ('aws_api', ?)",
+                (remaining,),
+            )
+
+    def connect(self):
+        # One connection per thread, sqlite3 connections can't be shared.
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def set(self, remaining):
+        self.connect().execute(
+            "INSERT OR REPLACE INTO quota (name, remaining, used) VALUES ('aws_api', ?, 0)",
+            (remaining,),
+        )
+
+    def remaining(self):
+        row = (
+            self.connect()
+            .execute("SELECT remaining FROM quota WHERE name = 'aws_api'")
+            .fetchone()
+        )
+        if row is None:
+            raise Exception(f"AWS API quota is not initialised in {self.path}")
+        return row[0]
+
+    def used(self):
+        row = (
+            self.connect()
+            .execute("SELECT used FROM quota WHERE name = 'aws_api'")
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def decrement(self, count=1):
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                """
+                UPDATE quota SET remaining = remaining - ?, used = used + ?
+                WHERE name = 'aws_api'
+                RETURNING remaining
+                """,
+                (count, count),
+            ).fetchone()
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if row is None:
+            raise Exception(f"AWS API quota is not initialised in {self.path}")
+
+        remaining = row[0]
+        for threshold in self.thresholds:
+            if remaining <= threshold < remaining + count:
+                self.emit_threshold(threshold, remaining)
+        return remaining
+
+    def emit_threshold(self, threshold, remaining):
+        logging.warning(
+            f"AWS API quota crossed {threshold}: {remaining} calls remaining"
+        )
+        for listener in self.listeners:
+            listener(threshold, remaining)
+
+
+def get_quota_ledger(path, seed_file=None):
+    with quota_ledgers_lock:
+        ledger = quota_ledgers.get(path)
+        if ledger is None:
+            ledger = QuotaLedger(path, seed_file)
+            quota_ledgers[path] = ledger
+        return ledger
+
+
+if __name__ == "__main__":
+    # python quota_utils.py [LEDGER] [--set N]
+    args = sys.argv[1:]
+    ledger = QuotaLedger(
+        args[0] if args and args[0] != "--set" else "./aws_api_quota.sqlite",
+        seed_file="./aws_api_quota_remaining",
+    )
+    if "--set" in args:
+        ledger.set(int(args[args.index("--set") + 1]))
+    print(f"remaining: {ledger.remaining()}, used: {ledger.used()}")
@@ -0,0 +1,108 @@
+import time
+import random
+import logging
+import threading
+
+
+class RetryBudget:
+    """
+    Token bucket that caps retries at a fraction of the requests made.
+
+    Every first attempt deposits `ratio` tokens and every retry withdraws one,
+    so when an upstream degrades the process settles at about one retry per
+    1/ratio requests instead of multiplying its load by the number of attempts.
+    """
+
+    def __init__(self, ratio=0.2, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+# Shared by every retry policy in the process.
+default_retry_budget = RetryBudget()
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, bounded by a number of attempts, a
+    total deadline and a retry budget.
+    """
+
+    def __init__(
+        self,
+        max_attempts=3,
+        base_delay=1.0,
+        max_delay=20.0,
+        deadline=120.0,
+        jitter=True,
+        budget=None,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.jitter = jitter
+        self.budget = budget or default_retry_budget
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def start(self):
+        self.budget.deposit()
+        return RetryState(self)
+
+
+class RetryState:
+    """Retry bookkeeping for one logical request."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.started = time.monotonic()
+        self.attempt = 1
+
+    def remaining(self):
+        return self.policy.deadline - (time.monotonic() - self.started)
+
+    def timeout(self, timeout):
+        # Never let a single attempt run past the overall deadline.
+        return max(0.1, min(timeout, self.remaining()))
+
+    def next_delay(self, retry_after=None):
+        """
+        Decide whether to retry after a failed attempt.
+
+        Parameters:
+            retry_after (str, optional): The Retry-After header of the response, if any. It's used as a lower bound of the delay.
+
+        Returns:
+            float or None: Seconds to wait before the next attempt, or None to give up.
+        """
+        if self.attempt >= self.policy.max_attempts:
+            return None
+        delay = self.policy.backoff(self.attempt)
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+        if delay >= self.remaining():
+            logging.info("retry deadline exceeded")
+            return None
+        if not self.policy.budget.withdraw():
+            logging.info("retry budget exhausted")
+            return None
+        self.attempt += 1
+        return delay
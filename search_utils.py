@@ -0,0 +1,91 @@
+from collections import Counter, defaultdict
+
+
+def trigrams(text):
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class TaskTitleIndex:
+    """
+    Trigram inverted index over task titles.
+
+    Titles are stored lowercased. `find` returns the IDs of the tasks whose title
+    contains the query, the same as a linear `query.lower() in title.lower()`
+    scan, in the order the tasks were added. `rank` orders tasks by how many
+    trigrams their title shares with the query, for near misses.
+    """
+
+    def __init__(self, tasks=()):
+        self.titles = {}
+        self.positions = {}
+        self.postings = defaultdict(set)
+        self.next_position = 0
+        for task_id, title in tasks:
+            self.add(task_id, title)
+
+    def __contains__(self, task_id):
+        return task_id in self.titles
+
+    def __len__(self):
+        return len(self.titles)
+
+    def add(self, task_id, title):
+        if task_id in self.titles:
+            self.remove(task_id)
+        title = title.lower()
+        self.titles[task_id] = title
+        self.positions[task_id] = self.next_position
+        self.next_position += 1
+        for gram in trigrams(title):
+            self.postings[gram].add(task_id)
+
+    def remove(self, task_id):
+        title = self.titles.pop(task_id, None)
+        if title is None:
+            return
+        del self.positions[task_id]
+        for gram in trigrams(title):
+            posting = self.postings[gram]
+            posting.discard(task_id)
+            if not posting:
+                del self.postings[gram]
+
+    def rename(self, task_id, title):
+        # Keep the original position so the ordering of matches doesn't change.
+        position = self.positions.get(task_id)
+        self.add(task_id, title)
+        if position is not None:
+            self.positions[task_id] = position
+
+    def find(self, query):
+        query = query.lower()
+        grams = trigrams(query)
+        if not grams:
+            ## Queries shorter than a trigram can't use the index.
+            candidates = self.titles
+        else:
+            ## Intersect the rarest posting lists first.
+            postings = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                if not candidates:
+                    break
+                candidates &= posting
+        found = [task_id for task_id in candidates if query in self.titles[task_id]]
+        return sorted(found, key=self.positions.__getitem__)
+
+    def rank(self, query, limit=5):
+        grams = trigrams(query.lower())
+        if not grams:
+            return []
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+
+        def jaccard(item):
+            task_id, count = item
+            union = len(grams) + len(trigrams(self.titles[task_id])) - count
+            return (-count / union, self.positions[task_id])
+
+        ranked = sorted(shared.items(), key=jaccard)
+        return [task_id for task_id, _ in ranked[:limit]]
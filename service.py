@@ -0,0 +1,215 @@
+"""
+Headless HTTP/JSON front-end of the task manager, for running it behind a
+load balancer instead of Streamlit.
+
+Usage:
+    python service.py [--host HOST] [--port PORT]
+
+Endpoints:
+    POST /instructions          {"instruction": "..."}, runs the instruction. A plan that needs
+                                confirmation is kept and answered with 202 and its plan_id.
+                                With an Idempotency-Key header, retries get the first answer back.
+    GET  /tasks                 The tasks snapshot, as given to the LLM.
+    POST /plans/{id}/confirm    Run a plan waiting for confirmation.
+    POST /plans/{id}/cancel     Drop a plan waiting for confirmation.
+
+Every request shares the process-wide LLM, agent pipeline, tasks snapshot
+cache and worker pools of llm_communication.
+"""
+
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import llm_communication
+
+# Runs student_llm and the other blocking calls off the event loop.
+request_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="service")
+# Plans not confirmed or cancelled within this time are dropped.
+PLAN_TTL_SECONDS = 15 * 60
+
+
+class PendingPlans:
+    """The ExecutionSessions waiting for their user's confirmation, by plan ID."""
+
+    def __init__(self, ttl=PLAN_TTL_SECONDS):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.plans = {}
+
+    def add(self, session, request_key=None):
+        plan_id = uuid.uuid4().hex
+        now = time.monotonic()
+        with self.lock:
+            for expired in [
+                key
+                for key, (_, created, _) in self.plans.items()
+                if now - created > self.ttl
+            ]:
+                del self.plans[expired]
+            self.plans[plan_id] = (session, now, request_key)
+        return plan_id
+
+    def pop(self, plan_id):
+        """
+        Returns:
+            tuple: The session and the Idempotency-Key of the instruction it answers, (None, None) if there's no such plan.
+        """
+        with self.lock:
+            session, created, request_key = self.plans.pop(plan_id, (None, None, None))
+        if session is None or time.monotonic() - created > self.ttl:
+            return None, None
+        return session, request_key
+
+
+PLANS = web.AppKey("plans", PendingPlans)
+
+
+def run_blocking(func, *args):
+    return asyncio.get_running_loop().run_in_executor(request_executor, func, *args)
+
+
+def error(status, message):
+    return web.json_response({"error": message}, status=status)
+
+
+def outcome_response(outcome):
+    status = 202 if outcome["status"] == "awaiting_confirmation" else 200
+    return web.json_response(outcome, status=status)
+
+
+def recorded_outcome(request_key):
+    return llm_communication.get_request_journal().get(request_key)
+
+
+def record_outcome(request_key, outcome):
+    # Retries of the request get the same answer without planning it again.
+    if request_key is not None:
+        llm_communication.get_request_journal().record(request_key, outcome)
+
+
+def ask_later(message, callbacks):
+    # The confirmation is asked by answering 202, the callbacks are the
+    # session's own execute and cancel.
+    pass
+
+
+async def submit_instruction(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return error(400, "The body must be JSON.")
+    instruction = body.get("instruction") if isinstance(body, dict) else None
+    if not isinstance(instruction, str) or not instruction.strip():
+        return error(400, '"instruction" must be a non-empty string.')
+
+    session = llm_communication.ExecutionSession(confirm=ask_later)
+    request_key = request.headers.get("Idempotency-Key")
+    if request_key is not None:
+        outcome = await run_blocking(recorded_outcome, request_key)
+        if outcome is not None:
+            return outcome_response(outcome)
+    try:
+        applied = await run_blocking(
+            lambda: llm_communication.student_llm(
+                instruction, session=session, request_key=request_key
+            )
+        )
+    except Exception:
+        logging.exception("instruction failed")
+        return error(500, "The instruction could not be carried out.")
+
+    if session.queue:
+        plan_id = request.app[PLANS].add(session, request_key)
+        outcome = {
+            "status": "awaiting_confirmation",
+            "plan_id": plan_id,
+            "message": llm_communication.CONFIRMATION_MESSAGE,
+            "plan": session.plan,
+        }
+    elif applied:
+        outcome = {"status": "applied", "plan": session.plan}
+    elif request_key is not None:
+        ## A concurrent retry of the request applied it first.
+        outcome = await run_blocking(recorded_outcome, request_key)
+        outcome = outcome or {"status": "empty", "plan": session.plan}
+    else:
+        outcome = {"status": "empty", "plan": session.plan}
+    await run_blocking(record_outcome, request_key, outcome)
+    return outcome_response(outcome)
+
+
+async def get_tasks(request):
+    data = await run_blocking(llm_communication.get_tasks_data)
+    # Already JSON, no need to decode and encode it again.
+    return web.Response(text=data, content_type="application/json")
+
+
+async def confirm_plan(request):
+    plan_id = request.match_info["plan_id"]
+    session, request_key = request.app[PLANS].pop(plan_id)
+    if session is None:
+        return error(404, f"No plan {plan_id} is waiting for confirmation.")
+    try:
+        applied = await run_blocking(session.execute, plan_id)
+    except Exception:
+        logging.exception(f"plan {plan_id} failed")
+        return error(500, "The plan could not be carried out, nothing was changed.")
+    outcome = {
+        "status": "applied" if applied else "already_applied",
+        "plan": session.plan,
+    }
+    await run_blocking(record_outcome, request_key, outcome)
+    return outcome_response(outcome)
+
+
+async def cancel_plan(request):
+    plan_id = request.match_info["plan_id"]
+    session, request_key = request.app[PLANS].pop(plan_id)
+    if session is None:
+        return error(404, f"No plan {plan_id} is waiting for confirmation.")
+    session.cancel()
+    outcome = {"status": "cancelled"}
+    await run_blocking(record_outcome, request_key, outcome)
+    return outcome_response(outcome)
+
+
+async def warm_up(app):
+    # Read the prompt, build the LLM client and the agent, and read the
+    # snapshot before the first request has to.
+    try:
+        await run_blocking(llm_communication.get_base_prompt)
+        await run_blocking(llm_communication.get_agent_pipeline)
+        await run_blocking(llm_communication.get_tasks_data)
+    except Exception:
+        logging.exception("warm-up failed, continuing without it")
+
+
+def make_app(warm=True):
+    app = web.Application()
+    app[PLANS] = PendingPlans()
+    app.add_routes(
+        [
+            web.post("/instructions", submit_instruction),
+            web.get("/tasks", get_tasks),
+            web.post("/plans/{plan_id}/confirm", confirm_plan),
+            web.post("/plans/{plan_id}/cancel", cancel_plan),
+        ]
+    )
+    if warm:
+        app.on_startup.append(warm_up)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP/JSON task manager service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    web.run_app(make_app(), host=args.host, port=args.port)
@@ -0,0 +1,94 @@
+import re
+import inspect
+import logging
+from difflib import SequenceMatcher
+
+# Minimum SequenceMatcher ratio for a fuzzy parameter match to be accepted.
+FUZZY_MATCH_THRESHOLD = 0.75
+
+
+def normalise(name):
+    # "dependsOn", "depends-on" and "Depends_On" are all "dependson".
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+class SignatureRegistry:
+    """
+    Maps the parameter names an LLM writes to the real parameters of functions.
+
+    Signatures are read once, when a function is registered. A name is looked
+    up as is, then by its normalised form (which also covers the aliases), and
+    only then compared with every known name with SequenceMatcher. Fuzzy
+    matches below `threshold` are rejected.
+    """
+
+    def __init__(self, functions=None, aliases=None, threshold=FUZZY_MATCH_THRESHOLD):
+        self.threshold = threshold
+        self.names = {}
+        self.fuzzy_cache = {}
+        for name, func in (functions or {}).items():
+            self.register(name, func, aliases)
+
+    def register(self, name, func, aliases=None):
+        """
+        Parameters:
+            name (str): The name the LLM calls the function by.
+            func (callable): The function.
+            aliases (dict, optional): Maps a parameter name to other names it may be given. Aliases of parameters the function doesn't have are ignored.
+        """
+        params = list(inspect.signature(func).parameters)
+        names = {}
+        for param in params:
+            for alias in (aliases or {}).get(param, ()):
+                names[normalise(alias)] = param
+        # A real parameter always wins over another parameter's alias.
+        for param in params:
+            names[normalise(param)] = param
+        self.names[name] = (set(params), names)
+        self.fuzzy_cache.pop(name, None)
+
+    def resolve(self, func_name, arg_name):
+        """
+        Returns:
+            str or None: The parameter `arg_name` refers to, or None if nothing is similar enough.
+        """
+        params, names = self.names[func_name]
+        if arg_name in params:
+            return arg_name
+        key = normalise(arg_name)
+        if key in names:
+            return names[key]
+
+        cache = self.fuzzy_cache.setdefault(func_name, {})
+        if key not in cache:
+            best, best_ratio = None, 0.0
+            for candidate, param in names.items():
+                ratio = SequenceMatcher(None, key, candidate).ratio()
+                if ratio > best_ratio:
+                    best, best_ratio = param, ratio
+            cache[key] = best if best_ratio >= self.threshold else None
+            logging.info(
+                f"fuzzy matched {func_name} parameter {arg_name!r} to {best!r} "
+                f"({best_ratio:.2f}, {'accepted' if cache[key] else 'rejected'})"
+            )
+        return cache[key]
+
+    def match(self, func_name, arguments):
+        """
+        Rename the LLM's arguments of a call to the function's parameter names.
+
+        Parameters:
+            func_name (str): A registered function name.
+            arguments (dict): The arguments as written by the LLM.
+
+        Returns:
+            dict: The arguments under their parameter names. Arguments that match no parameter are dropped.
+        """
+        matched = {}
+        for arg_name, value in arguments.items():
+            param = self.resolve(func_name, arg_name)
+            if param is None:
+                logging.info(f"Dropped unknown {func_name} parameter {arg_name!r}")
+                continue
+            matched[param] = value
+        return matched
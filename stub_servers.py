@@ -0,0 +1,200 @@
+"""
+Local stand-ins for the external HTTP APIs, used by tests.py and benchmarks.py.
+"""
+
+import ssl
+import json
+import time
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LLMStubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive between requests.
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length))
+        with self.server.lock:
+            self.server.requests.append(body)
+            self.server.connections.add(self.client_address)
+            failure = self.server.failures.pop(0) if self.server.failures else None
+
+        if failure is None and body.get("stream"):
+            return self.stream_generation(body["prompt"])
+        if failure is None:
+            status = 200
+            response = {"body": {"generation": self.server.generate(body["prompt"])}}
+        elif isinstance(failure, int):
+            status, response = failure, {"message": "stub failure"}
+        else:
+            status, response = failure
+        payload = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def stream_generation(self, prompt):
+        # One {"generation": ...} line per chunk of chunk_size characters.
+        text = self.server.generate(prompt)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i in range(0, len(text), self.server.chunk_size):
+                line = json.dumps({"generation": text[i : i + self.server.chunk_size]})
+                payload = (line + "\n").encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(payload), payload))
+                self.wfile.flush()
+                time.sleep(self.server.chunk_delay)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            with self.server.lock:
+                self.server.aborted_streams += 1
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OWMStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        city = parse_qs(url.query).get("q", [""])[0]
+        with self.server.lock:
+            self.server.requests.append((url.path, city))
+
+        if url.path != "/data/2.5/forecast":
+            status, response = 404, {"cod": "404", "message": "unknown endpoint"}
+        elif city.lower() not in self.server.cities:
+            status, response = 404, {"cod": "404", "message": "city not found"}
+        else:
+            status, response = 200, self.forecast(city)
+        payload = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def forecast(self, city):
+        # 5 days in 3 hour steps, like the real /forecast endpoint.
+        start = self.server.start
+        return {
+            "cod": "200",
+            "cnt": 40,
+            "city": {"id": 1, "name": city, "coord": {"lat": 0, "lon": 0}},
+            "list": [
+                {
+                    "dt": start + i * 3 * 3600,
+                    "main": {
+                        "temp": 290.15 + i,
+                        "temp_min": 289.15 + i,
+                        "temp_max": 291.15 + i,
+                        "feels_like": 290.15 + i,
+                        "humidity": 50,
+                        "pressure": 1013,
+                    },
+                    "weather": [
+                        {
+                            "id": 800,
+                            "main": "Clear",
+                            "description": "clear sky",
+                            "icon": "01d",
+                        }
+                    ],
+                    "clouds": {"all": 0},
+                    "wind": {"speed": 1.5, "deg": 90},
+                }
+                for i in range(40)
+            ],
+        }
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(handler, certfile=None, keyfile=None, **attributes):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_llm_stub(
+    generate=lambda prompt: "<JSON>[]</JSON>",
+    failures=(),
+    certfile=None,
+    keyfile=None,
+    chunk_size=8,
+    chunk_delay=0,
+):
+    """
+    Serve the LLM endpoint's response format on a random local port.
+
+    Requests with `"stream": true` get the generation back as chunked
+    newline-delimited {"generation": ...} objects.
+
+    Parameters:
+        generate (callable): Maps a prompt to the generated text.
+        failures (list, optional): Responses to give before generating anything, each either an HTTP status or a (status, JSON body) tuple.
+        certfile (str, optional): Certificate to serve HTTPS with. Defaults to plain HTTP.
+        keyfile (str, optional): Private key of the certificate.
+        chunk_size (int, optional): Characters per streamed chunk.
+        chunk_delay (float, optional): Seconds to wait after each streamed chunk.
+
+    Returns:
+        ThreadingHTTPServer: The running server. `url` is the endpoint to post to, `requests` the received bodies and `connections` the distinct client addresses seen and `aborted_streams` the streams the client hung up on. Call `shutdown()` when done.
+    """
+    server = start_stub_server(
+        LLMStubHandler,
+        certfile,
+        keyfile,
+        generate=generate,
+        failures=list(failures),
+        requests=[],
+        connections=set(),
+        chunk_size=chunk_size,
+        chunk_delay=chunk_delay,
+        aborted_streams=0,
+    )
+    scheme = "https" if certfile else "http"
+    server.url = f"{scheme}://127.0.0.1:{server.server_port}/generate"
+    return server
+
+
+def start_owm_stub(cities=("Zurich",), start=None):
+    """
+    Serve the OpenWeatherMap 3 hourly forecast endpoint on a random local port.
+
+    Parameters:
+        cities (iterable): Cities that have a forecast, every other city is answered with 404.
+        start (int, optional): UNIX time of the first forecast step. Defaults to the last 3 hour boundary.
+
+    Returns:
+        ThreadingHTTPServer: The running server. `root_uri` is the API root to give to pyowm and `requests` the (path, city) pairs received. Call `shutdown()` when done.
+    """
+    if start is None:
+        start = int(time.time()) // (3 * 3600) * 3 * 3600
+    server = start_stub_server(
+        OWMStubHandler,
+        cities={city.lower() for city in cities},
+        start=start,
+        requests=[],
+    )
+    server.root_uri = f"http://127.0.0.1:{server.server_port}/data/2.5"
+    return server
@@ -1,9 +1,23 @@
 import unittest
-from unittest.mock import patch, call
+from unittest.mock import patch, call, MagicMock
 import logging
+import os
+import sys
+import time
+import tempfile
+import threading
+import subprocess
+import datetime
 from itertools import permutations
 from functools import reduce
 import re
+import json
+import random
+from itertools import islice
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import io
 
 import llm_communication
 from llm_communication import (
@@ -15,8 +29,28 @@ from llm_communication import (
     execute_commands,
     parse_llm_output_and_populate_commands,
     get_tasks_data,
+    stream_json_block,
+    ExecutionSession,
+)
+from langchain_utils import LLAMA2, OpenWeatherMapAPIWrapper, invoke_many
+from search_utils import TaskTitleIndex
+from stub_servers import start_llm_stub, start_owm_stub
+from quota_utils import QuotaLedger, get_quota_ledger
+from retry_utils import RetryBudget
+from cache_utils import ResponseCache
+from classifier_utils import WeatherCheckClassifier
+from signature_utils import SignatureRegistry
+from todocli_utils import read_tasks, read_tasks_data, TodoCommandError
+from service import make_app
+from execution_utils import plan_batches, plan_dependencies, run_dependency_graph
+from parsing_utils import (
+    strip_ansi,
+    fix_json_literals,
+    standardize_date_format,
+    parse_tasks_data,
+    iter_search_records,
+    TaskRecord,
 )
-from langchain_utils import LLAMA2
 
 logging.basicConfig(
     level=logging.INFO,
@@ -780,6 +814,1517 @@ instruction: Move all high-importance items from my task_list to my priorities_l
             )
 
 
+class TestTodoBackend(unittest.TestCase):
+    def run_commands(self, backend):
+        reset_todocli()
+        with patch("llm_communication.TODO_BACKEND", backend):
+            todo_add(title="Elden Ring", context="games", priority=5)
+            todo_add(title="bananas", context="shoppinglist", deadline="2030-01-01")
+            todo_mark_as_done(["bananas"])
+            outputs = [
+                todo_list(flat=True),
+                todo_search("", is_done=False),
+                todo_search("", is_done=True),
+                llm_communication.todo_history(),
+                get_tasks_data(),
+                llm_communication.scrape_tasks_data(),
+            ]
+        # Creation timestamps differ between the two runs
+        return [
+            re.sub(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}", "<created>", o)
+            for o in outputs
+        ]
+
+    def test_inprocess_matches_subprocess(self):
+        self.assertEqual(
+            self.run_commands("inprocess"), self.run_commands("subprocess")
+        )
+
+    def test_inprocess_keeps_other_threads_output(self):
+        setup_testing_env()
+        stop = threading.Event()
+        printed = []
+
+        def chatter():
+            while not stop.is_set():
+                printed.append(f"chatter {len(printed)}")
+                print(printed[-1])
+
+        with patch("llm_communication.TODO_BACKEND", "inprocess"), patch(
+            "sys.stdout", new_callable=io.StringIO
+        ) as stdout:
+            thread = threading.Thread(target=chatter)
+            thread.start()
+            try:
+                outputs = [todo_list(flat=True) for _ in range(5)]
+            finally:
+                stop.set()
+                thread.join()
+        self.assertFalse(any("chatter" in output for output in outputs))
+        self.assertEqual(stdout.getvalue().split(), " ".join(printed).split())
+
+
+class TestTasksDataCache(unittest.TestCase):
+    def test_repeated_reads_are_cached(self):
+        setup_testing_env()
+        snapshot = get_tasks_data()
+        with patch(
+            "llm_communication.fetch_tasks_data",
+            wraps=llm_communication.fetch_tasks_data,
+        ) as mock_fetch_tasks_data:
+            for _ in range(3):
+                self.assertEqual(get_tasks_data(), snapshot)
+            mock_fetch_tasks_data.assert_not_called()
+            llm_communication.invalidate_tasks_data()
+            self.assertEqual(get_tasks_data(), snapshot)
+            mock_fetch_tasks_data.assert_called_once()
+
+    def test_mutation_invalidates_cache(self):
+        setup_testing_env()
+        get_tasks_data()
+        todo_add(title="mamala", context="homework")
+        self.assertIn("mamala", get_tasks_data())
+        todo_mark_as_done("mamala")
+        self.assertIn('"title": "mamala", "status": "DONE"', get_tasks_data())
+
+
+class TestTaskIdResolution(unittest.TestCase):
+    def test_get_task_ids_reports_per_item(self):
+        setup_testing_env()
+        llm_communication.invalidate_tasks_data()
+        with patch(
+            "llm_communication.fetch_tasks_data",
+            wraps=llm_communication.fetch_tasks_data,
+        ) as mock_fetch_tasks_data:
+            resolved = llm_communication.get_task_ids(
+                ["elden ring", "write", "9", "mamala"]
+            )
+            # A single snapshot for all names
+            mock_fetch_tasks_data.assert_called_once()
+        self.assertEqual(
+            [(item["name"], item["id"], item["status"]) for item in resolved],
+            [
+                ("elden ring", "1", "found"),
+                ("write", None, "ambiguous"),
+                ("9", "9", "found"),
+                ("mamala", None, "missing"),
+            ],
+        )
+        self.assertEqual(sorted(resolved[1]["matches"]), ["5", "6"])
+
+    def test_todo_rm_skips_unresolved_names(self):
+        setup_testing_env()
+        with patch(
+            "llm_communication.log_and_exec_process",
+            wraps=llm_communication.log_and_exec_process,
+        ) as mock_log_and_exec_process:
+            llm_communication.todo_rm(["bananas", "write", "rust"])
+            mock_log_and_exec_process.assert_any_call("todo rm 9 2", "todo_rm")
+
+
+class TestTaskTitleIndex(unittest.TestCase):
+    def test_find_matches_linear_scan(self):
+        titles = ["Write Test", "Write Diary", "water the pots", "Rust", "apples"]
+        index = TaskTitleIndex((str(i), title) for i, title in enumerate(titles))
+        for query in ["write", "WRITE T", "t", "the pots", "ru", "xyz", "es"]:
+            expected = [
+                str(i)
+                for i, title in enumerate(titles)
+                if query.lower() in title.lower()
+            ]
+            self.assertEqual(index.find(query), expected)
+
+    def test_incremental_updates(self):
+        index = TaskTitleIndex([("1", "Elden Ring"), ("2", "bananas")])
+        index.add("3", "Elden Lord")
+        self.assertEqual(index.find("elden"), ["1", "3"])
+        index.rename("1", "Dark Souls")
+        self.assertEqual(index.find("elden"), ["3"])
+        index.remove("3")
+        self.assertEqual(index.find("elden"), [])
+        self.assertEqual(index.rank("banana split")[0], "2")
+
+    def test_index_follows_todo_mutations(self):
+        setup_testing_env()
+        llm_communication.get_title_index()
+        todo_add(title="mamala", context="homework")
+        llm_communication.todo_task("mamala", title="coding session")
+        with patch(
+            "llm_communication.log_and_exec_process",
+            wraps=llm_communication.log_and_exec_process,
+        ) as mock_log_and_exec_process:
+            self.assertEqual(llm_communication.get_task_id("coding"), "e")
+            self.assertFalse(llm_communication.get_task_id("mamala"))
+            # Served from the updated index, without a new snapshot
+            mock_log_and_exec_process.assert_not_called()
+        llm_communication.todo_rm(["coding"])
+        self.assertFalse(llm_communication.get_task_id("coding"))
+
+    def test_index_follows_concurrent_mutations(self):
+        setup_testing_env()
+        llm_communication.get_title_index()
+        titles = [f"foo {i}" for i in range(6)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [
+                executor.submit(todo_add, title=title, context="homework")
+                for title in titles
+            ] + [
+                executor.submit(llm_communication.todo_rm, [name])
+                for name in ("bananas", "rust")
+            ]
+            for future in futures:
+                future.result()
+        updated = llm_communication.get_title_index()
+        llm_communication.invalidate_title_index()
+        rebuilt = llm_communication.get_title_index()
+        for name in titles + ["bananas", "rust", "foo"]:
+            self.assertEqual(updated.find(name), rebuilt.find(name), name)
+
+    def test_mutations_run_concurrently(self):
+        setup_testing_env()
+        lock = threading.Lock()
+        running = peak = 0
+
+        def slow_command(command, func_name):
+            nonlocal running, peak
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.2)
+            with lock:
+                running -= 1
+
+        with patch("llm_communication.log_and_exec_process", slow_command):
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                list(executor.map(lambda title: todo_add(title=title), "abc"))
+        self.assertEqual(peak, 3)
+
+
+class LLMStubTestCase(unittest.TestCase):
+    generate = staticmethod(lambda prompt: "<JSON>[]</JSON>")
+    failures = ()
+    chunk_delay = 0
+
+    def setUp(self):
+        self.server = start_llm_stub(
+            self.generate, self.failures, chunk_delay=self.chunk_delay
+        )
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.quota_db = os.path.join(self.tmp_dir.name, "aws_api_quota.sqlite")
+        self.quota = get_quota_ledger(self.quota_db)
+        self.quota.set(100)
+        self.cache_db = os.path.join(self.tmp_dir.name, "llm_cache.sqlite")
+        self.env = patch.dict(os.environ, {"AWS_API_KEY": "test"})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def make_llm(self, **kwargs):
+        kwargs.setdefault("backoff_base", 0.01)
+        return LLAMA2(
+            api_url=self.server.url,
+            quota_db=self.quota_db,
+            response_cache_db=self.cache_db,
+            **kwargs,
+        )
+
+
+class TestLLAMA2Session(LLMStubTestCase):
+    def test_pooled_session_reuses_connection(self):
+        llm = self.make_llm()
+        for i in range(5):
+            self.assertEqual(llm.invoke(f"hello {i}"), "<JSON>[]</JSON>")
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_hosts_keep_their_connections(self):
+        other = start_llm_stub(self.generate, ())
+        try:
+            llms = [
+                self.make_llm(),
+                LLAMA2(
+                    api_url=other.url,
+                    quota_db=self.quota_db,
+                    response_cache_db=self.cache_db,
+                ),
+            ]
+            for i in range(3):
+                for j, llm in enumerate(llms):
+                    llm.invoke(f"hello {i} {j}")
+            self.assertEqual(len(self.server.connections), 1)
+            self.assertEqual(len(other.connections), 1)
+        finally:
+            other.shutdown()
+            other.server_close()
+
+    def test_without_session_opens_new_connections(self):
+        llm = self.make_llm(use_session=False)
+        for i in range(3):
+            llm.invoke(f"hello {i}")
+        self.assertEqual(len(self.server.connections), 3)
+
+
+class TestLLAMA2Async(LLMStubTestCase):
+    @staticmethod
+    def generate(prompt):
+        time.sleep(0.5)
+        return f"echo: {prompt}"
+
+    def test_prompts_run_concurrently(self):
+        llm = self.make_llm()
+        prompts = [f"prompt {i}" for i in range(4)]
+        start = time.perf_counter()
+        results = invoke_many(llm, prompts, max_concurrency=4)
+        self.assertLess(time.perf_counter() - start, 1.5)
+        self.assertEqual(results, [f"echo: {prompt}" for prompt in prompts])
+
+    def test_concurrency_respects_quota(self):
+        self.quota.set(2)
+        llm = self.make_llm()
+        results = invoke_many(llm, ["a", "b", "c", "d"], max_concurrency=4)
+        self.assertEqual(results[:2], ["echo: a", "echo: b"])
+        self.assertTrue(all(isinstance(r, Exception) for r in results[2:]))
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class TestQuotaLedger(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "aws_api_quota.sqlite")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_seeded_from_legacy_file(self):
+        seed_file = os.path.join(self.tmp_dir.name, "aws_api_quota_remaining")
+        with open(seed_file, "w") as f:
+            f.write("42")
+        ledger = QuotaLedger(self.path, seed_file)
+        self.assertEqual(ledger.remaining(), 42)
+        ledger.decrement()
+        # An existing ledger is never re-seeded
+        self.assertEqual(QuotaLedger(self.path, seed_file).remaining(), 41)
+
+    def test_concurrent_decrements_are_not_lost(self):
+        QuotaLedger(self.path).set(1000)
+        processes = [
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    "import sys; from quota_utils import QuotaLedger; "
+                    "ledger = QuotaLedger(sys.argv[1]); "
+                    "[ledger.decrement() for _ in range(50)]",
+                    self.path,
+                ]
+            )
+            for _ in range(4)
+        ]
+        ledger = QuotaLedger(self.path)
+        threads = [
+            threading.Thread(target=lambda: [ledger.decrement() for _ in range(50)])
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for process in processes:
+            self.assertEqual(process.wait(), 0)
+        self.assertEqual(ledger.remaining(), 600)
+        self.assertEqual(ledger.used(), 400)
+
+    def test_thresholds_emitted_once(self):
+        ledger = QuotaLedger(self.path, thresholds=(10, 0))
+        ledger.set(12)
+        crossed = []
+        ledger.listeners.append(lambda threshold, remaining: crossed.append(threshold))
+        for _ in range(13):
+            ledger.decrement()
+        self.assertEqual(crossed, [10, 0])
+
+
+class TestLLAMA2Retries(LLMStubTestCase):
+    def test_retryable_responses_are_retried(self):
+        self.server.failures.extend([503, 429, (200, {"body": {}})])
+        self.assertEqual(self.make_llm(retries=4).invoke("hello"), "<JSON>[]</JSON>")
+        self.assertEqual(len(self.server.requests), 4)
+        # The throttled request never reached the model
+        self.assertEqual(self.quota.used(), 3)
+
+    def test_client_errors_fail_fast(self):
+        self.server.failures.append(400)
+        with self.assertRaises(Exception):
+            self.make_llm().invoke("hello")
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_deadline_stops_retrying(self):
+        self.server.failures.extend([503] * 3)
+        llm = self.make_llm(backoff_base=5, retry_deadline=1)
+        with patch("retry_utils.random.uniform", lambda a, b: b):
+            with self.assertRaises(Exception):
+                llm.invoke("hello")
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_retry_budget_limits_retries(self):
+        self.server.failures.extend([503] * 10)
+        with patch("retry_utils.default_retry_budget", RetryBudget(max_tokens=1)):
+            with self.assertRaises(Exception):
+                self.make_llm(retries=10).invoke("hello")
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_async_retries(self):
+        self.server.failures.extend([502])
+        self.assertEqual(invoke_many(self.make_llm(), ["hello"]), ["<JSON>[]</JSON>"])
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class TestLLAMA2ResponseCache(LLMStubTestCase):
+    def test_identical_prompts_hit_cache(self):
+        llm = self.make_llm()
+        for _ in range(3):
+            self.assertEqual(llm.invoke("hello"), "<JSON>[]</JSON>")
+        self.assertEqual(invoke_many(llm, ["hello"]), ["<JSON>[]</JSON>"])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.quota.used(), 1)
+
+    def test_parameters_are_part_of_the_key(self):
+        self.make_llm().invoke("hello")
+        self.make_llm(temperature=0.7).invoke("hello")
+        self.make_llm(max_gen_len=16).invoke("hello")
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_bypass(self):
+        llm = self.make_llm()
+        llm.invoke("hello")
+        llm.invoke("hello", bypass_cache=True)
+        self.make_llm(use_response_cache=False).invoke("hello")
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_ttl_and_lru_eviction(self):
+        cache = ResponseCache(self.cache_db, ttl=60, max_bytes=10)
+        cache.put("a", "12345")
+        cache.put("b", "12345")
+        cache.get("a")
+        cache.put("c", "12345")
+        # b was the least recently used entry
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "12345")
+        expired = time.time() + 61
+        with patch("cache_utils.time.time", lambda: expired):
+            self.assertIsNone(cache.get("a"))
+
+
+class TestLLAMA2Streaming(LLMStubTestCase):
+    generate = staticmethod(
+        lambda prompt: '<JSON>[{"function": "todo_list"}]</JSON>' + " reasoning" * 40
+    )
+    chunk_delay = 0.005
+
+    def test_stream_matches_invoke(self):
+        llm = self.make_llm(streaming=True, use_response_cache=False)
+        chunks = list(llm.stream("hello"))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), llm.invoke("hello"))
+        self.assertTrue(self.server.requests[0]["stream"])
+        self.assertEqual(self.quota.used(), 2)
+
+    def test_stops_after_json_block(self):
+        llm = self.make_llm(streaming=True, use_response_cache=False)
+        start = time.perf_counter()
+        list(llm.stream("hello"))
+        full = time.perf_counter() - start
+
+        start = time.perf_counter()
+        response = stream_json_block(llm, "hello")
+        early = time.perf_counter() - start
+        self.assertEqual(response, '<JSON>[{"function": "todo_list"}]</JSON>')
+        self.assertLess(early, full / 2)
+
+    def test_only_complete_streams_are_cached(self):
+        llm = self.make_llm(streaming=True)
+        stream_json_block(llm, "hello")
+        list(llm.stream("hello"))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(llm.invoke("hello"), self.generate("hello"))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_falls_back_to_call_on_error(self):
+        self.server.failures = [503]
+        llm = self.make_llm(streaming=True)
+        self.assertEqual("".join(llm.stream("hello")), self.generate("hello"))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertNotIn("stream", self.server.requests[1])
+
+
+class TestAgentPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.template = os.path.join(self.tmp_dir.name, "agent_prompt_template.txt")
+        with open("./agent_prompt_template.txt", "r") as src:
+            with open(self.template, "w") as dst:
+                dst.write(src.read())
+        self.patches = [
+            patch("llm_communication.AGENT_PROMPT_TEMPLATE_FILE", self.template),
+            patch.dict(
+                llm_communication.agent_pipeline,
+                {"key": None, "llm": None, "agent_executor": None},
+            ),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        self.tmp_dir.cleanup()
+
+    def test_built_once(self):
+        with patch(
+            "llm_communication.build_agent_pipeline",
+            wraps=llm_communication.build_agent_pipeline,
+        ) as build:
+            executors = []
+            threads = [
+                threading.Thread(
+                    target=lambda: executors.append(
+                        llm_communication.get_agent_pipeline()[1]
+                    )
+                )
+                for _ in range(8)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(build.call_count, 1)
+            self.assertEqual(len(executors), 8)
+            self.assertEqual(len({id(e) for e in executors}), 1)
+
+    def test_rebuilt_when_template_changes(self):
+        llm, agent_executor = llm_communication.get_agent_pipeline()
+        with open(self.template, "a") as f:
+            f.write("\n")
+        self.assertIsNot(llm_communication.get_agent_pipeline()[1], agent_executor)
+
+
+class TestWeatherCheckClassifier(unittest.TestCase):
+    def test_crud_instructions_skip_the_agent(self):
+        classifier = WeatherCheckClassifier()
+        for instruction in [
+            'can you remove "bananas" and "rust" from my items?',
+            "remove bananas",
+            "can you list my items in games list?",
+            "can you set the deadline of study math to September 10 2025?",
+            "can you set the start of planning to 2024/10/11 12:34:22?",
+            "Move all completed tasks from my project_list to an archive_list",
+            "what is the meaning of life? tell me I desperately need it.",
+            "add 2.5 hours of gardening",
+            "buy 1.5 kg of apples at Migros",
+        ]:
+            self.assertFalse(classifier.needs_weather_check(instruction), instruction)
+        self.assertEqual(classifier.skip_rate(), 1.0)
+
+    def test_outdoor_instructions_run_the_agent(self):
+        classifier = WeatherCheckClassifier()
+        for instruction in [
+            "add a hike in Zurich tomorrow at 10am",
+            "I want to go swimming at the lake on 2024-07-01 14:00",
+            "schedule a picnic with Anna on Saturday in the park",
+            "add visiting the market in Paris on 12th of May",
+            "add football training next week, paris",
+            "Schedule a picnic in Paris on June 3rd",
+            "add a hike in Zurich on 25.05",
+            "football training in Munich on the 5th",
+            "go cycling around Lucerne",
+            "In Paris tomorrow, remind me to buy bread",
+            "add the flea market at Bern on 3/05",
+        ]:
+            self.assertTrue(classifier.needs_weather_check(instruction), instruction)
+        self.assertEqual(classifier.skip_rate(), 0.0)
+
+    def test_student_llm_skips_agent(self):
+        llm = MagicMock(streaming=False)
+        llm.invoke.return_value = "<JSON>[]</JSON>"
+        agent_executor = MagicMock()
+        agent_executor.invoke.return_value = {"output": "sunny"}
+        with patch(
+            "llm_communication.get_agent_pipeline",
+            return_value=(llm, agent_executor),
+        ), patch("llm_communication.set_raw_llm_response"):
+            llm_communication.student_llm("remove bananas")
+            agent_executor.invoke.assert_not_called()
+            self.assertIn("<<weather check report>>: \n", llm.invoke.call_args[0][0])
+
+            llm_communication.student_llm("add a hike in Zurich tomorrow")
+            agent_executor.invoke.assert_called_once()
+            self.assertIn("<<weather check report>>: sunny", llm.invoke.call_args[0][0])
+
+
+class TestStudentLLMStages(unittest.TestCase):
+    def test_agent_and_snapshot_run_in_parallel(self):
+        llm = MagicMock(streaming=False)
+        llm.invoke.return_value = "<JSON>[]</JSON>"
+        agent_executor = MagicMock()
+        agent_executor.invoke.side_effect = lambda _: time.sleep(0.3) or {
+            "output": "sunny"
+        }
+
+        def slow_tasks_data():
+            time.sleep(0.3)
+            return "[]"
+
+        with patch(
+            "llm_communication.get_agent_pipeline",
+            return_value=(llm, agent_executor),
+        ), patch("llm_communication.get_tasks_data", slow_tasks_data), patch(
+            "llm_communication.set_raw_llm_response"
+        ), patch(
+            "llm_communication.weather_preclassifier_enabled", False
+        ), self.assertLogs(
+            level="INFO"
+        ) as logs:
+            start = time.perf_counter()
+            llm_communication.student_llm("add a hike in Zurich tomorrow")
+            elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 0.5)
+        prompt = llm.invoke.call_args[0][0]
+        self.assertIn("JSON format:\n[]\n", prompt)
+        self.assertIn("<<weather check report>>: sunny", prompt)
+        timings = [line for line in logs.output if "stage timings" in line]
+        self.assertEqual(len(timings), 1)
+        for stage in ("pipeline", "weather_agent", "tasks_data", "task_manager"):
+            self.assertIn(f"{stage}=", timings[0])
+
+
+class TestForecastCache(unittest.TestCase):
+    def setUp(self):
+        self.server = start_owm_stub(cities=["Zurich", "Berlin"])
+        self.cache = patch.dict("langchain_utils.forecast_cache", clear=True)
+        self.cache.start()
+        self.weather = self.make_weather()
+
+    def tearDown(self):
+        self.cache.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_weather(self, **kwargs):
+        # The stub ignores the key, it's only there so that the tests don't
+        # depend on OPENWEATHERMAP_API_KEY.
+        return OpenWeatherMapAPIWrapper(
+            openweathermap_api_key="test", owm_root_uri=self.server.root_uri, **kwargs
+        )
+
+    def city_date(self, city, hours):
+        date = datetime.datetime.utcfromtimestamp(self.server.start + hours * 3600)
+        return f"{city}, {date:%Y-%m-%d %H:%M:%S}"
+
+    def test_lookups_served_from_cache(self):
+        first = self.weather.run(self.city_date("Zurich", 0))
+        self.assertIn("Current: 17.0°C", first)
+        # Another time, case and wrapper instance still hit the cached forecast.
+        later = self.make_weather().run(self.city_date("zurich", 6))
+        self.assertIn("Current: 19.0°C", later)
+        self.assertEqual(self.weather.run(self.city_date("Zurich", 0)), first)
+        self.weather.run(self.city_date("Berlin", 0))
+        self.assertEqual(
+            [city for _, city in self.server.requests], ["Zurich", "Berlin"]
+        )
+
+    def test_expires_at_three_hour_boundary(self):
+        boundary = 1_700_006_400  # a multiple of 3 hours
+        with patch("langchain_utils.time.time", return_value=boundary - 1):
+            self.weather.get_forecast("Zurich")
+            self.weather.get_forecast("Zurich")
+        self.assertEqual(len(self.server.requests), 1)
+        with patch("langchain_utils.time.time", return_value=boundary):
+            self.weather.get_forecast("Zurich")
+            self.weather.get_forecast("Zurich")
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_cache_is_per_api_key(self):
+        self.weather.run(self.city_date("Zurich", 0))
+        OpenWeatherMapAPIWrapper(
+            openweathermap_api_key="other", owm_root_uri=self.server.root_uri
+        ).run(self.city_date("Zurich", 0))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_failures_are_not_cached(self):
+        for _ in range(2):
+            self.assertIn(
+                "Tool failed to execute", self.weather.run(self.city_date("Nowhere", 0))
+            )
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_cache_can_be_disabled(self):
+        weather = self.make_weather(use_forecast_cache=False)
+        weather.run(self.city_date("Zurich", 0))
+        weather.run(self.city_date("Zurich", 0))
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class TestLazyOWMClient(unittest.TestCase):
+    def test_import_without_api_key(self):
+        env = {k: v for k, v in os.environ.items() if k != "OPENWEATHERMAP_API_KEY"}
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import llm_communication, langchain_utils\n"
+                "w = langchain_utils.OpenWeatherMapAPIWrapper()\n"
+                "print(w.run('Zurich, 2024-01-01 10:00:00'))",
+            ],
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Tool failed to execute", result.stdout)
+
+    def test_one_client_per_key(self):
+        with patch.dict("langchain_utils.owm_clients", clear=True):
+            clients = []
+            threads = [
+                threading.Thread(
+                    target=lambda: clients.append(
+                        OpenWeatherMapAPIWrapper(openweathermap_api_key="key").owm
+                    )
+                )
+                for _ in range(8)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(len({id(c) for c in clients}), 1)
+            self.assertEqual(clients[0].api_key, "key")
+
+
+class TestImportTime(unittest.TestCase):
+    HEAVY_MODULES = ["langchain.agents", "numpy", "pyowm", "streamlit", "aiohttp"]
+
+    def test_heavy_modules_imported_on_use(self):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, llm_communication\n"
+                f"print([m for m in {self.HEAVY_MODULES} if m in sys.modules])",
+            ],
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "[]")
+
+    def test_base_prompt_still_available(self):
+        with open("./base_prompt.txt", "r") as f:
+            self.assertEqual(llm_communication.BASE_PROMPT, f.read())
+
+
+class TestSignatureRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = llm_communication.signature_registry
+
+    def test_exact_alias_and_normalised_names(self):
+        self.assertEqual(
+            self.registry.match(
+                "todo_add",
+                {"title": "x", "ctx": "home", "dueDate": "2024-01-01", "Depends-On": 1},
+            ),
+            {
+                "title": "x",
+                "context": "home",
+                "deadline": "2024-01-01",
+                "depends_on": 1,
+            },
+        )
+        self.assertEqual(self.registry.match("todo_rm", {"id": [1]}), {"ids": [1]})
+        self.assertEqual(self.registry.match("todo_task", {"task_id": 1}), {"id": 1})
+        # "name" is a real parameter of todo_edit_ctx, not an alias of title.
+        self.assertEqual(
+            self.registry.match("todo_edit_ctx", {"name": "x"}), {"name": "x"}
+        )
+
+    def test_fuzzy_fallback_and_threshold(self):
+        self.assertEqual(
+            self.registry.match("todo_add", {"priorty": 2, "deadlin": None}),
+            {"priority": 2, "deadline": None},
+        )
+        # argmax used to map these to whatever parameter was closest.
+        self.assertEqual(
+            self.registry.match("todo_add", {"title": "x", "colour": "red"}),
+            {"title": "x"},
+        )
+
+    def test_signatures_read_once(self):
+        def func(alpha, beta=None):
+            pass
+
+        with patch("signature_utils.inspect.signature", wraps=inspect.signature) as sig:
+            registry = SignatureRegistry({"func": func})
+            for _ in range(3):
+                registry.match("func", {"alpha": 1, "Beta": 2, "alpah": 3})
+        self.assertEqual(sig.call_count, 1)
+
+    def test_parse_uses_registry(self):
+        with patch.object(llm_communication, "confirmation_mechanism_enabled", False):
+            parse_llm_output_and_populate_commands(
+                '<JSON>[{"function": "todo_add", "parameters": '
+                '{"task_name": "x", "importance": 3, "colour": "red"}}]</JSON>'
+            )
+        ((func, params, _),) = llm_communication.execution_queue
+        llm_communication.empty_execution_queue()
+        self.assertEqual(func, llm_communication.todo_add)
+        self.assertEqual(params, {"title": "x", "priority": 3})
+
+
+class TestParsingUtils(unittest.TestCase):
+    def test_strip_ansi(self):
+        self.assertEqual(
+            strip_ansi(" \x1b[33m1\x1b[0m | \x1b[32m[DONE]\x1b[0m Buy milk"),
+            " 1 | [DONE] Buy milk",
+        )
+
+    def test_fix_json_literals(self):
+        self.assertEqual(
+            fix_json_literals('{"a": True, "b": False, "c": None, "d": "Trueish"}'),
+            '{"a": true, "b": false, "c": null, "d": "Trueish"}',
+        )
+
+    def test_standardize_date_format(self):
+        self.assertEqual(
+            standardize_date_format("2024/1/2 and 12/31/2024 10:00:00"),
+            "2024-01-02 and 2024-12-31 10:00:00",
+        )
+
+    def test_parse_tasks_data(self):
+        search = (
+            " 1 | [DONE] Buy milk ★3 #home\n"
+            " 2 | Write report ⌛ ⌛ 3 days remaining\n"
+        )
+        history = (
+            "id title        created             context status\n"
+            "-- ------------ ------------------- ------- ------\n"
+            " 1 Buy milk     2024-01-01 10:00:00 home    DONE  \n"
+            " 2 Write report 2024-01-01 10:00:00                \n"
+        )
+        self.assertEqual(
+            json.loads(parse_tasks_data(search, history)),
+            [
+                {
+                    "id": "1",
+                    "sort_by": 0,
+                    "priority": "3",
+                    "context": "home",
+                    "title": "Buy milk",
+                    "status": "DONE",
+                },
+                {
+                    "id": "2",
+                    "sort_by": 1,
+                    "priority": None,
+                    "context": None,
+                    "title": "Write report",
+                    "status": "UNDONE",
+                },
+            ],
+        )
+        self.assertEqual(parse_tasks_data("", "No history."), "[]")
+
+
+def legacy_parse_tasks_data(tasks_flat_list, tasks_history):
+    # The regex and column-finder parser parse_tasks_data replaced.
+    tasks_data = defaultdict(dict)
+    pattern = re.compile(
+        r"^\s(\w+)\s+\|\s+(\[DONE\])?([^★#\U0000231b\n]+)(?:\U0000231b[^★#]+)?(?:★(\d+))?\s?(?:#(\w+))?",
+        re.MULTILINE,
+    )
+    for i, match in enumerate(pattern.finditer(tasks_flat_list)):
+        id = match.group(1)
+        tasks_data[id]["sort_by"] = i
+        tasks_data[id]["priority"] = match.group(4)
+        tasks_data[id]["context"] = match.group(5)
+        tasks_data[id]["title"] = match.group(3).strip()
+    lines = tasks_history.strip().split("\n")
+    if not lines == ["No history."]:
+        header_line = lines[1]
+        field_bounds = []
+        last_pos = 0
+        while True:
+            start = header_line.find("-", last_pos)
+            if start == -1:
+                break
+            end = header_line.find(" ", start)
+            if end == -1:
+                end = len(header_line)
+            field_bounds.append((start, end))
+            last_pos = end
+        for line in lines[2:]:
+            id = line[field_bounds[0][0] : field_bounds[0][1]].strip()
+            if len(field_bounds) > 4:
+                tasks_data[id]["status"] = line[
+                    field_bounds[4][0] : field_bounds[4][1]
+                ].strip()
+            if not tasks_data[id]["status"]:
+                tasks_data[id]["status"] = "UNDONE"
+    tasks_data = [{"id": key, **value} for key, value in tasks_data.items()]
+    return json.dumps(tasks_data)
+
+
+def random_todocli_output(rng, n):
+    # Single-line tasks laid out like todocli prints them.
+    alphabet = "abcdefghij klmnop QRST 0123 .,:;!?()[]-_'\"/"
+    # Ids of one width: the old parser skipped right-aligned shorter ones.
+    width = rng.randint(1, 3)
+    population = range(max(1, 16 ** (width - 1)), 16**width)
+    ids = [f"{i:x}" for i in rng.sample(population, min(n, len(population)))]
+    search, history = [], []
+    for id in ids:
+        done = rng.random() < 0.3
+        title = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 30)))
+        title = title.strip() or "x"
+        priority = str(rng.randint(0, 99)) if rng.random() < 0.5 else None
+        context = (
+            rng.choice(["home", "work_2", "a.b", "x"]) if rng.random() < 0.6 else None
+        )
+        if rng.random() < 0.3 and (priority or context):
+            deadline = f"⌛ {rng.randint(1, 400)} days remaining"
+        else:
+            deadline = None
+        line = f" {id:>{width}} | " + ("[DONE] " if done else "") + title
+        metadata = [
+            deadline,
+            priority and f"★{priority}",
+            context and f"#{context}",
+        ]
+        line += "".join(" " + m for m in metadata if m)
+        search.append(line)
+        history.append(
+            (
+                id,
+                title[:20],
+                "2024-01-01 10:00:00",
+                context or "",
+                "DONE" if done else "",
+            )
+        )
+    rng.shuffle(history)
+    widths = [max(len(h[i]) for h in history) or 1 for i in range(5)]
+    widths = [
+        max(w, len(name))
+        for w, name in zip(widths, ["id", "title", "created", "context", "status"])
+    ]
+    rows = [
+        ("id", "title", "created", "context", "status"),
+        tuple("-" * w for w in widths),
+    ] + history
+    history = "\n".join(
+        " ".join(
+            f"{v:>{w}}" if i == 0 else f"{v:<{w}}"
+            for i, (v, w) in enumerate(zip(row, widths))
+        )
+        for row in rows
+    )
+    return "\n".join(search) + "\n", history + "\n"
+
+
+class TestTasksDataParser(unittest.TestCase):
+    def test_fuzz_matches_legacy_parser(self):
+        rng = random.Random(0)
+        for case in range(300):
+            search, history = random_todocli_output(rng, rng.randint(1, 40))
+            self.assertEqual(
+                json.loads(parse_tasks_data(search, history)),
+                json.loads(legacy_parse_tasks_data(search, history)),
+                f"case {case}:\n{search}\n{history}",
+            )
+            self.assertEqual(
+                parse_tasks_data(search, history),
+                legacy_parse_tasks_data(search, history),
+            )
+
+    def test_history_without_status_column(self):
+        history = "id  title\n--  -----\n 1  short\n"
+        self.assertEqual(
+            json.loads(parse_tasks_data(" 1 | short ★3 #home\n", history)),
+            [
+                {
+                    "id": "1",
+                    "sort_by": 0,
+                    "priority": "3",
+                    "context": "home",
+                    "title": "short",
+                    "status": "UNDONE",
+                }
+            ],
+        )
+
+    def test_wrapped_title(self):
+        search = (
+            " 1 | a title long enough for todocli to wrap it over\n"
+            "     two lines ★3 #home\n"
+            " 2 | short\n"
+        )
+        records = list(iter_search_records(search.splitlines()))
+        self.assertEqual(
+            [(r.id, r.title, r.priority, r.context) for r in records],
+            [
+                (
+                    "1",
+                    "a title long enough for todocli to wrap it over two lines",
+                    "3",
+                    "home",
+                ),
+                ("2", "short", None, None),
+            ],
+        )
+
+    def test_deadline_does_not_swallow_next_task(self):
+        # The old regex ran from the deadline to the next ★ or #, over lines.
+        search = " 1 | report ⌛ 3 days remaining\n 2 | plain\n 3 | other #work\n"
+        records = list(iter_search_records(search.splitlines()))
+        self.assertEqual(
+            [(r.id, r.context) for r in records],
+            [("1", None), ("2", None), ("3", "work")],
+        )
+        self.assertEqual(
+            len(json.loads(legacy_parse_tasks_data(search, "No history."))), 1
+        )
+
+    def test_right_aligned_ids(self):
+        search = "  1 | task 1\n  f | task 15 ★2\n 10 | task 16 #home\n"
+        records = list(iter_search_records(search.splitlines()))
+        self.assertEqual([r.id for r in records], ["1", "f", "10"])
+        self.assertEqual(
+            len(json.loads(legacy_parse_tasks_data(search, "No history."))), 1
+        )
+
+    def test_streams_records(self):
+        def endless_output():
+            i = 1
+            while True:
+                yield f" {i:x} | task {i} ★1\n"
+                i += 1
+
+        records = list(islice(iter_search_records(endless_output()), 3))
+        self.assertEqual([r.title for r in records], ["task 1", "task 2", "task 3"])
+        self.assertFalse(hasattr(records[0], "__dict__"))
+        self.assertEqual(TaskRecord("a").to_dict(), {"id": "a"})
+
+
+class TestTasksDataSource(unittest.TestCase):
+    def test_sqlite_matches_cli(self):
+        setup_testing_env()
+        todo_mark_as_done(["bananas", "Rust"])
+        self.assertEqual(
+            read_tasks_data(llm_communication.get_todo_data_dir()),
+            llm_communication.scrape_tasks_data(),
+        )
+
+    def test_filters(self):
+        setup_testing_env()
+        todo_add(title="Standup", context="work.meetings")
+        todo_add(title="Soldering", context="workshop")
+        todo_mark_as_done(["Planning"])
+        data_dir = llm_communication.get_todo_data_dir()
+
+        def titles(**filters):
+            return [r.title for r in read_tasks(data_dir, **filters)]
+
+        self.assertEqual(
+            titles(context="work"), ["Write Test", "Apply", "Standup", "Planning"]
+        )
+        self.assertEqual(titles(context="work", done=True), ["Planning"])
+        self.assertEqual(titles(term="WRITE"), ["Write Test", "Write Diary"])
+        self.assertEqual(
+            titles(after="2000-01-01 00:00:00", term="sold"), ["Soldering"]
+        )
+        self.assertEqual(titles(before="2000-01-01 00:00:00"), [])
+        standup = next(read_tasks(data_dir, term="standup"))
+        self.assertEqual(standup.context, "work.meetings")
+
+    def test_filters_match_literally(self):
+        setup_testing_env()
+        for title in ["50% off", "500 pages", "a_b", "axb", "back\\slash"]:
+            todo_add(title=title, context="literal_ctx")
+        todo_add(title="elsewhere", context="literalxctx.sub")
+        data_dir = llm_communication.get_todo_data_dir()
+
+        def titles(**filters):
+            return [r.title for r in read_tasks(data_dir, **filters)]
+
+        self.assertEqual(titles(term="50%"), ["50% off"])
+        self.assertEqual(titles(term="a_b"), ["a_b"])
+        self.assertEqual(titles(term="k\\s"), ["back\\slash"])
+        self.assertNotIn("elsewhere", titles(context="literal_ctx"))
+
+    def test_falls_back_to_cli(self):
+        setup_testing_env()
+        expected = llm_communication.scrape_tasks_data()
+        with patch("llm_communication.get_todo_data_dir", return_value="/nonexistent"):
+            self.assertEqual(llm_communication.fetch_tasks_data(), expected)
+
+
+BATCHED_RESPONSE = """<JSON>
+[
+    {"function": "todo_rm", "parameters": {"ids": ["bananas"]}, "log": "remove bananas"},
+    {"function": "todo_rm", "parameters": {"ids": "rust"}, "log": "remove rust"},
+    {"function": "todo_add", "parameters": {"title": "mamala", "context": "homework"}},
+    {"function": "todo_add", "parameters": {"title": "coding session", "context": "homework"}},
+    {"function": "todo_task", "parameters": {"id": "elden ring", "priority": 7}},
+    {"function": "todo_task", "parameters": {"id": "cleaning", "priority": 7}},
+    {"function": "todo_mark_as_done", "parameters": {"ids": ["mamala"]}}
+]
+</JSON>"""
+
+# "cleaning" is ambiguous once elden ring is renamed.
+RENAMING_RESPONSE = """<JSON>
+[
+    {"function": "todo_task", "parameters": {"id": "elden ring", "title": "cleaning 2"}},
+    {"function": "todo_task", "parameters": {"id": "cleaning", "priority": 9}},
+    {"function": "todo_task", "parameters": {"id": "write test", "priority": 9}}
+]
+</JSON>"""
+
+
+class TestExecutionPlanner(unittest.TestCase):
+    def test_groups_consecutive_calls(self):
+        parse_llm_output_and_populate_commands(BATCHED_RESPONSE)
+        batches = plan_batches(llm_communication.execution_queue)
+        llm_communication.empty_execution_queue()
+        self.assertEqual(
+            [(batch.kind, len(batch.calls)) for batch in batches],
+            [("merge", 2), ("session", 2), ("resolve", 2), ("merge", 1)],
+        )
+        self.assertEqual(batches[0].call_names(), [["bananas"], ["rust"]])
+
+        parse_llm_output_and_populate_commands(RENAMING_RESPONSE)
+        batches = plan_batches(llm_communication.execution_queue)
+        llm_communication.empty_execution_queue()
+        self.assertEqual(
+            [(batch.kind, len(batch.calls)) for batch in batches],
+            [("resolve", 1), ("resolve", 2)],
+        )
+
+    def test_batched_execution(self):
+        setup_testing_env()
+        parse_llm_output_and_populate_commands(BATCHED_RESPONSE)
+        with patch(
+            "llm_communication.log_and_exec_process",
+            wraps=llm_communication.log_and_exec_process,
+        ) as mock_log_and_exec_process, patch(
+            "subprocess.run", wraps=subprocess.run
+        ) as mock_run:
+            execute_commands()
+        llm_communication.empty_execution_queue()
+
+        commands = [c.args[0] for c in mock_log_and_exec_process.mock_calls]
+        # Independent batches run concurrently, only "done" has to wait for the adds.
+        self.assertGreater(
+            commands.index("todo done e"),
+            commands.index('todo add "mamala" --context "homework" --priority 1'),
+        )
+        self.assertCountEqual(
+            commands,
+            [
+                "todo rm 9 2",
+                'todo add "mamala" --context "homework" --priority 1',
+                'todo add "coding session" --context "homework" --priority 1',
+                "todo task 1 --priority 7",
+                "todo task 7 --priority 7",
+                "todo done e",
+            ],
+        )
+        # The adds ran in the todocli worker process.
+        self.assertEqual(mock_run.call_count, 4)
+        batched = get_tasks_data()
+
+        setup_testing_env()
+        parse_llm_output_and_populate_commands(BATCHED_RESPONSE)
+        for func, func_params, _ in llm_communication.execution_queue:
+            func(**func_params)
+        llm_communication.empty_execution_queue()
+        self.assertEqual(batched, get_tasks_data())
+
+    def test_merged_calls_see_earlier_removals(self):
+        # "write" matches both tasks until "write test" is removed.
+        calls = [
+            {"function": "todo_rm", "parameters": {"ids": ["write test"]}},
+            {"function": "todo_rm", "parameters": {"ids": ["write"]}},
+        ]
+        results = []
+        for batched in (True, False):
+            setup_testing_env()
+            parse_llm_output_and_populate_commands(f"<JSON>{json.dumps(calls)}</JSON>")
+            if batched:
+                self.assertEqual(
+                    [
+                        batch.kind
+                        for batch in plan_batches(llm_communication.execution_queue)
+                    ],
+                    ["merge"],
+                )
+                execute_commands()
+            else:
+                for func, func_params, _ in llm_communication.execution_queue:
+                    func(**func_params)
+            llm_communication.empty_execution_queue()
+            results.append(get_tasks_data())
+        self.assertEqual(results[0], results[1])
+        self.assertNotIn("Write Diary", results[0])
+
+    def test_batched_renames(self):
+        setup_testing_env()
+        parse_llm_output_and_populate_commands(RENAMING_RESPONSE)
+        # A transaction fails on the ambiguous name, compare the plain runs.
+        with patch(
+            "llm_communication.log_and_exec_process",
+            wraps=llm_communication.log_and_exec_process,
+        ) as mock_log_and_exec_process, patch(
+            "llm_communication.transactional_execution_enabled", False
+        ):
+            execute_commands()
+        llm_communication.empty_execution_queue()
+
+        commands = [c.args[0] for c in mock_log_and_exec_process.mock_calls]
+        self.assertNotIn("todo task 7 --priority 9", commands)
+        self.assertIn('todo task 1 --title "cleaning 2"', commands)
+        batched = get_tasks_data()
+
+        setup_testing_env()
+        parse_llm_output_and_populate_commands(RENAMING_RESPONSE)
+        for func, func_params, _ in llm_communication.execution_queue:
+            func(**func_params)
+        llm_communication.empty_execution_queue()
+        self.assertEqual(batched, get_tasks_data())
+
+
+class TestDependencyExecutor(unittest.TestCase):
+    def plan(self, response):
+        parse_llm_output_and_populate_commands(response)
+        batches = plan_batches(llm_communication.execution_queue)
+        llm_communication.empty_execution_queue()
+        return plan_dependencies(batches, llm_communication.resolve_task_names)
+
+    def test_plan_dependencies(self):
+        setup_testing_env()
+        # "mamala" is created by the adds, the other batches touch different tasks.
+        self.assertEqual(self.plan(BATCHED_RESPONSE), [set(), set(), set(), {1}])
+
+        calls = [
+            {"function": "todo_rm", "parameters": {"ids": ["elden"]}},
+            {"function": "todo_add", "parameters": {"title": "elden lord"}},
+            {"function": "todo_task", "parameters": {"id": "5", "context": "work.x"}},
+            {"function": "todo_mark_as_done", "parameters": {"ids": "write test"}},
+            {"function": "todo_list", "parameters": {}},
+            {"function": "todo_location", "parameters": {}},
+            {"function": "todo_add", "parameters": {"title": "x", "context": "home"}},
+        ]
+        self.assertEqual(
+            self.plan(f"<JSON>{json.dumps(calls)}</JSON>"),
+            [set(), {0}, set(), {2}, {0, 1, 2, 3}, set(), {1, 4}],
+        )
+
+    def test_runs_independent_items_concurrently(self):
+        events = []
+        lock = threading.Lock()
+
+        def run(item):
+            with lock:
+                events.append(("start", item))
+            time.sleep(0.05)
+            with lock:
+                events.append(("end", item))
+
+        executor = ThreadPoolExecutor(max_workers=4)
+        start = time.perf_counter()
+        run_dependency_graph(
+            ["a", "b", "c", "d"], [set(), set(), {0}, set()], run, executor
+        )
+        self.assertLess(time.perf_counter() - start, 0.15)
+        self.assertLess(events.index(("end", "a")), events.index(("start", "c")))
+        self.assertEqual({item for kind, item in events[:3]}, {"a", "b", "d"})
+
+    def test_failure_stops_dependents(self):
+        ran = []
+
+        def run(item):
+            ran.append(item)
+            if item == "a":
+                raise ValueError(item)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        with self.assertRaises(ValueError):
+            run_dependency_graph(["a", "b"], [set(), {0}], run, executor)
+        self.assertEqual(ran, ["a"])
+
+
+class TestTransactionalExecution(unittest.TestCase):
+    def queue(self, calls):
+        parse_llm_output_and_populate_commands(f"<JSON>{json.dumps(calls)}</JSON>")
+
+    def test_rolls_back_on_failure(self):
+        setup_testing_env()
+        before = get_tasks_data()
+        calls = [
+            {"function": "todo_rm", "parameters": {"ids": ["bananas"]}},
+            {"function": "todo_add", "parameters": {"title": "mamala"}},
+            {"function": "todo_add", "parameters": {"title": "y", "depends_on": "zz"}},
+        ]
+        self.queue(calls)
+        with self.assertRaises(TodoCommandError):
+            execute_commands(request_key="request 1")
+        self.assertEqual(get_tasks_data(), before)
+
+        # A rolled back plan isn't in the journal, fixing it applies it.
+        calls[2]["parameters"]["depends_on"] = "1"
+        self.queue(calls)
+        execute_commands(request_key="request 1")
+        data = get_tasks_data()
+        self.assertIn('"title": "mamala"', data)
+        self.assertNotIn('"title": "bananas"', data)
+
+    def test_unresolved_names_roll_back(self):
+        for failing in [
+            {
+                "function": "todo_task",
+                "parameters": {"id": "no such task", "priority": 3},
+            },
+            {"function": "todo_rm", "parameters": {"ids": ["write"]}},
+            {"function": "todo_add", "parameters": {"title": "y", "depends_on": "ff"}},
+        ]:
+            setup_testing_env()
+            before = get_tasks_data()
+            self.queue(
+                [
+                    {"function": "todo_rm", "parameters": {"ids": ["bananas"]}},
+                    {"function": "todo_add", "parameters": {"title": "mamala"}},
+                    failing,
+                    {"function": "todo_mark_as_done", "parameters": {"ids": ["rust"]}},
+                ]
+            )
+            with self.assertRaises(TodoCommandError):
+                execute_commands(request_key="request 1")
+            self.assertEqual(get_tasks_data(), before, failing)
+            self.queue([{"function": "todo_add", "parameters": {"title": "mamala"}}])
+            # The request wasn't recorded.
+            self.assertTrue(execute_commands(request_key="request 1"))
+
+    def test_retry_is_applied_once(self):
+        setup_testing_env()
+        calls = [{"function": "todo_add", "parameters": {"title": "mamala"}}]
+        for _ in range(2):
+            self.queue(calls)
+            execute_commands(request_key="request 1")
+        self.assertEqual(get_tasks_data().count('"title": "mamala"'), 1)
+
+        self.queue(calls)
+        execute_commands(request_key="request 2")
+        self.assertEqual(get_tasks_data().count('"title": "mamala"'), 2)
+
+        # A retry is recognised by its key, however the LLM words its plan.
+        calls[0]["log"] = "adding mamala again"
+        self.queue(calls)
+        self.assertFalse(execute_commands(request_key="request 2"))
+        self.assertEqual(get_tasks_data().count('"title": "mamala"'), 2)
+        llm_communication.empty_execution_queue()
+
+    def test_plans_without_request_key_always_apply(self):
+        setup_testing_env()
+        add = [{"function": "todo_add", "parameters": {"title": "milk"}}]
+        remove = [{"function": "todo_rm", "parameters": {"ids": ["milk"]}}]
+        applied = []
+        for calls in (add, remove, add):
+            self.queue(calls)
+            applied.append(execute_commands())
+        self.assertEqual(applied, [True, True, True])
+        self.assertEqual(get_tasks_data().count('"title": "milk"'), 1)
+
+
+SIMULATED_SESSIONS = 16
+
+
+def session_response(session, count=3):
+    calls = [
+        {
+            "function": "todo_add",
+            "parameters": {
+                "title": f"session {session} task {i}",
+                "context": f"session{session}",
+                "ask_confirmation": True,
+            },
+        }
+        for i in range(count)
+    ]
+    return f"<JSON>{json.dumps(calls)}</JSON>"
+
+
+class TestExecutionSessions(unittest.TestCase):
+    def test_sessions_are_isolated(self):
+        setup_testing_env()
+        first, second = ExecutionSession(), ExecutionSession()
+        with patch("llm_communication.get_user_confirmation") as confirm:
+            self.assertFalse(first.populate(BATCHED_RESPONSE))
+            self.assertTrue(second.populate(session_response(2)))
+        self.assertEqual(confirm.call_args.kwargs["callbacks"][0], second.execute)
+        # Neither touches the module's queue.
+        self.assertEqual(llm_communication.execution_queue, [])
+        first.cancel()
+        self.assertFalse(first.execute())
+        self.assertTrue(second.execute())
+        data = get_tasks_data()
+        self.assertIn('"title": "bananas"', data)
+        self.assertIn('"title": "session 2 task 0"', data)
+
+    def test_load(self):
+        setup_testing_env()
+        barrier = threading.Barrier(SIMULATED_SESSIONS)
+        asked = []
+
+        def user(i):
+            answers = {}
+
+            def confirm(message, callbacks):
+                asked.append(i)
+                answers["run"], answers["cancel"] = callbacks
+
+            session = ExecutionSession(confirm=confirm)
+            session.populate(session_response(i))
+            # Every session has its plan pending before anyone answers.
+            barrier.wait()
+            # Odd users decline.
+            answers["cancel" if i % 2 else "run"]()
+
+        with ThreadPoolExecutor(max_workers=SIMULATED_SESSIONS) as executor:
+            list(executor.map(user, range(SIMULATED_SESSIONS)))
+
+        self.assertCountEqual(asked, range(SIMULATED_SESSIONS))
+        tasks = json.loads(get_tasks_data())
+        for i in range(SIMULATED_SESSIONS):
+            titles = [t["title"] for t in tasks if t.get("context") == f"session{i}"]
+            expected = [] if i % 2 else [f"session {i} task {j}" for j in range(3)]
+            self.assertEqual(titles, expected)
+
+
+class TestService(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        from aiohttp.test_utils import TestClient, TestServer
+
+        setup_testing_env()
+        self.llm = MagicMock(streaming=False)
+        self.pipeline = patch(
+            "llm_communication.get_agent_pipeline",
+            return_value=(self.llm, MagicMock()),
+        )
+        self.pipeline.start()
+        self.client = TestClient(TestServer(make_app(warm=False)))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.pipeline.stop()
+
+    async def submit(self, instruction, response, **kwargs):
+        self.llm.invoke.return_value = response
+        return await self.client.post(
+            "/instructions", json={"instruction": instruction}, **kwargs
+        )
+
+    async def titles(self):
+        response = await self.client.get("/tasks")
+        self.assertEqual(response.status, 200)
+        return [task.get("title") for task in await response.json()]
+
+    async def test_submit_applies_plan(self):
+        response = await self.submit("remove bananas", BATCHED_RESPONSE)
+        self.assertEqual(response.status, 200)
+        body = await response.json()
+        self.assertEqual(body["status"], "applied")
+        self.assertEqual(len(body["plan"]), 7)
+        titles = await self.titles()
+        self.assertNotIn("bananas", titles)
+        self.assertIn("coding session", titles)
+
+    async def test_confirm_and_cancel(self):
+        before = await self.titles()
+        response = await self.submit("add my tasks", session_response(1))
+        self.assertEqual(response.status, 202)
+        plan_id = (await response.json())["plan_id"]
+        self.assertEqual(await self.titles(), before)
+
+        response = await self.client.post(f"/plans/{plan_id}/confirm")
+        self.assertEqual((await response.json())["status"], "applied")
+        self.assertIn("session 1 task 2", await self.titles())
+        response = await self.client.post(f"/plans/{plan_id}/confirm")
+        self.assertEqual(response.status, 404)
+
+        response = await self.submit("add my tasks", session_response(2))
+        plan_id = (await response.json())["plan_id"]
+        response = await self.client.post(f"/plans/{plan_id}/cancel")
+        self.assertEqual((await response.json())["status"], "cancelled")
+        self.assertNotIn("session 2 task 0", await self.titles())
+
+    async def test_idempotency_key(self):
+        bodies = []
+        for log in ["add mamala", "adding mamala"]:
+            # The retry's plan would be worded differently.
+            calls = [
+                {"function": "todo_add", "parameters": {"title": "mamala"}, "log": log}
+            ]
+            response = await self.submit(
+                "add mamala",
+                f"<JSON>{json.dumps(calls)}</JSON>",
+                headers={"Idempotency-Key": "1"},
+            )
+            self.assertEqual(response.status, 200)
+            bodies.append(await response.json())
+        self.assertEqual(bodies[0]["status"], "applied")
+        self.assertEqual(bodies[1], bodies[0])
+        self.assertEqual((await self.titles()).count("mamala"), 1)
+        # The retry isn't planned again.
+        self.llm.invoke.assert_called_once()
+
+    async def test_confirmed_retry(self):
+        headers = {"Idempotency-Key": "2"}
+        response = await self.submit(
+            "add my tasks", session_response(1), headers=headers
+        )
+        plan_id = (await response.json())["plan_id"]
+        response = await self.submit(
+            "add my tasks", session_response(1), headers=headers
+        )
+        self.assertEqual(response.status, 202)
+        self.assertEqual((await response.json())["plan_id"], plan_id)
+
+        await self.client.post(f"/plans/{plan_id}/confirm")
+        response = await self.submit(
+            "add my tasks", session_response(1), headers=headers
+        )
+        self.assertEqual((await response.json())["status"], "applied")
+        self.assertEqual((await self.titles()).count("session 1 task 0"), 1)
+
+    async def test_errors_are_not_exposed(self):
+        self.llm.invoke.side_effect = ValueError("secret details")
+        response = await self.client.post(
+            "/instructions", json={"instruction": "remove bananas"}
+        )
+        self.assertEqual(response.status, 500)
+        self.assertNotIn("secret", await response.text())
+
+    async def test_bad_request(self):
+        response = await self.client.post("/instructions", data="not json")
+        self.assertEqual(response.status, 400)
+        response = await self.client.post("/instructions", json={"instruction": ""})
+        self.assertEqual(response.status, 400)
+
+
 if __name__ == "__main__":
     llm_communication.confirmation_mechanism_enabled = False
     unittest.main()
@@ -0,0 +1,289 @@
+import io
+import os
+import re
+import sys
+import json
+import shlex
+import logging
+import sqlite3
+import threading
+import contextlib
+import subprocess
+from datetime import datetime, timezone
+
+from parsing_utils import TaskRecord, encode_records
+
+# todocli writes to the process-wide stdout and reads sys.argv, so in-process
+# commands have to be serialized.
+_todocli_lock = threading.Lock()
+_todocli_modules = None
+# The long-lived processes running todocli, by working directory: todocli picks
+# its data directory from the working directory when it's imported.
+_todocli_workers = {}
+_todocli_workers_lock = threading.Lock()
+
+# Width todocli falls back to when its stdout is a pipe, as with `bash -c`.
+PIPE_TERMINAL_WIDTH = 80
+
+
+def _pipe_terminal_width():
+    return PIPE_TERMINAL_WIDTH
+
+
+def _load_todocli():
+    global _todocli_modules
+    if _todocli_modules is None:
+        from todo import todo as todo_main, utils as todo_utils, cli_parser
+
+        ## Render tables the same way a subprocess with captured stdout does.
+        todo_utils.get_terminal_width = _pipe_terminal_width
+        _todocli_modules = (todo_main, todo_utils, cli_parser)
+    return _todocli_modules
+
+
+def _refresh_todocli_clock(todo_main, todo_utils, cli_parser):
+    # todocli computes NOW once at import time, which is fine for a short lived
+    # CLI but not for a long lived process resolving deadlines like "2w".
+    now = datetime.utcnow().replace(tzinfo=timezone.utc)
+    todo_utils.NOW = now
+    todo_main.NOW = now
+    cli_parser.NOW = now
+
+
+class TodoCommandError(RuntimeError):
+    """A todo command failed."""
+
+
+# What todocli prints, exiting with 0, when it couldn't do what it was asked.
+FAILURE_OUTPUT_PATTERN = re.compile(
+    r"""
+    ^(
+        Task\s\S+\snot\sfound
+        | Tasks?\snot\sfound:
+        | Dependencies\snot\sset\sbecause\snot\sexisting:
+        | Context\sdoes\snot\sexist:
+        | Context\salready\sexists:
+    ).*$
+    """,
+    re.MULTILINE | re.VERBOSE,
+)
+
+
+def check_todo_output(command, output):
+    """Raise TodoCommandError if todocli reported a failure in the command's output."""
+    match = FAILURE_OUTPUT_PATTERN.search(output or "")
+    if match:
+        raise TodoCommandError(f"{command!r} failed: {match.group(0).strip()}")
+
+
+class TodocliWorker:
+    """
+    A long-lived `python todocli_utils.py` process running todo commands.
+
+    Commands and their results are exchanged as one JSON line each over the
+    process's stdin and stdout, one command at a time.
+    """
+
+    def __init__(self, cwd):
+        self.lock = threading.Lock()
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            cwd=cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+
+    def run(self, command, argv, check):
+        with self.lock:
+            try:
+                self.process.stdin.write(json.dumps([command, argv, check]) + "\n")
+                self.process.stdin.flush()
+                line = self.process.stdout.readline()
+            except OSError:
+                line = ""
+        if not line:
+            raise BrokenPipeError(f"the todocli worker exited running {command!r}")
+        reply = json.loads(line)
+        if reply["error"] is not None:
+            raise TodoCommandError(reply["error"])
+        return reply["stdout"]
+
+
+def _get_todocli_worker(cwd):
+    with _todocli_workers_lock:
+        worker = _todocli_workers.get(cwd)
+        if worker is None or worker.process.poll() is not None:
+            worker = TodocliWorker(cwd)
+            _todocli_workers[cwd] = worker
+        return worker
+
+
+def serve_todocli_worker():
+    # The worker's side of TodocliWorker. todocli's output is captured, the
+    # replies go to the real stdout.
+    replies = sys.stdout
+    for line in sys.stdin:
+        command, argv, check = json.loads(line)
+        try:
+            reply = {"stdout": _run_argv(command, argv, check), "error": None}
+        except TodoCommandError as e:
+            reply = {"stdout": None, "error": str(e)}
+        replies.write(json.dumps(reply) + "\n")
+        replies.flush()
+
+
+def run_todo_command(command, check=False):
+    """
+    Run a `todo ...` command string in a long-lived todocli worker process.
+
+    todocli prints to the process-wide stdout. Capturing it in this process
+    would also capture what other threads print meanwhile, so the commands
+    run in a worker started in the current working directory.
+
+    Parameters:
+        command (str): The command as it would be passed to `bash -c`.
+        check (bool, optional): Raise TodoCommandError when todocli exits with an error instead of only logging it. Defaults to False.
+
+    Returns:
+        str: Everything todocli printed to stdout.
+    """
+    argv = shlex.split(command)
+    if not argv or argv[0] != "todo":
+        raise ValueError(f"Not a todo command: {command}")
+
+    return _get_todocli_worker(os.getcwd()).run(command, argv, check)
+
+
+def _run_argv(command, argv, check):
+    # Runs in the worker process.
+    todo_main, todo_utils, cli_parser = _load_todocli()
+    stdout = io.StringIO()
+    with _todocli_lock:
+        _refresh_todocli_clock(todo_main, todo_utils, cli_parser)
+        old_argv, old_stdin = sys.argv, sys.stdin
+        # Confirmation prompts (purge, rmctx without --force) get an EOF, like a
+        # subprocess without a terminal attached would.
+        sys.argv, sys.stdin = argv, io.StringIO()
+        try:
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(
+                io.StringIO()
+            ):
+                todo_main.main()
+        except SystemExit as e:
+            if check and e.code not in (None, 0):
+                raise TodoCommandError(f"{command!r} exited with {e.code}")
+        except Exception as e:
+            logging.info(f"todo command failed in-process: {e!r}")
+            if check:
+                raise TodoCommandError(f"{command!r} failed: {e!r}") from e
+        finally:
+            sys.argv, sys.stdin = old_argv, old_stdin
+
+    return stdout.getvalue()
+
+
+def get_last_task_id(data_dir):
+    """
+    Return the hexadecimal ID todocli gave to the most recently added task.
+
+    Parameters:
+        data_dir (str): The todocli data directory, as printed by `todo --location`.
+
+    Returns:
+        str or None: The ID, or None if no task was ever added.
+    """
+    # `todo add` prints nothing, but Task ids come from AUTOINCREMENT.
+    connection = sqlite3.connect(os.path.join(data_dir, "data.sqlite"))
+    try:
+        row = connection.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'Task'"
+        ).fetchone()
+    finally:
+        connection.close()
+    return hex(row[0])[2:] if row else None
+
+
+# The queries `todo search --undone` and `todo search --done` run, so rows come
+# back in the order todocli prints them.
+SEARCH_QUERY = """
+    SELECT t.id, t.title, t.priority, t.done, c.path AS ctx_path
+    FROM Task t JOIN Context c
+    ON t.context = c.id
+    WHERE t.title LIKE ? ESCAPE '\\'
+      AND c.path LIKE ? ESCAPE '\\'
+"""
+
+
+def escape_like(text):
+    # Match text literally in a LIKE pattern with ESCAPE '\'.
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def read_tasks(data_dir, term="", context=None, done=None, before=None, after=None):
+    """
+    Read tasks straight from todocli's database, without running todocli.
+
+    The filters are applied in SQL, on the columns todocli indexes.
+
+    Parameters:
+        data_dir (str): The todocli data directory, as printed by `todo --location`.
+        term (str, optional): Substring the title has to contain, case-insensitive.
+        context (str, optional): Only tasks in this context or its subcontexts.
+        done (bool, optional): Only done (True) or undone (False) tasks. Defaults to undone and then done ones.
+        before (str, optional): Only tasks created before this UTC time, formatted as YYYY-MM-DD HH:MM:SS.
+        after (str, optional): Only tasks created after this UTC time, formatted as YYYY-MM-DD HH:MM:SS.
+
+    Yields:
+        TaskRecord: The tasks, in the order `todo search` lists them.
+    """
+    path = os.path.join(data_dir, "data.sqlite")
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    # Read-only, so we never create or lock the database todocli owns.
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        query, params = SEARCH_QUERY, [f"%{escape_like(term)}%", "%"]
+        if context:
+            query += " AND (c.path = ? OR c.path LIKE ? ESCAPE '\\')"
+            params += [f".{context}", f".{escape_like(context)}.%"]
+        if before:
+            query += " AND t.created < ?"
+            params.append(before)
+        if after:
+            query += " AND t.created > ?"
+            params.append(after)
+
+        sort_by = 0
+        for is_done in [False, True] if done is None else [done]:
+            condition = " AND t.done IS NOT NULL" if is_done else " AND t.done IS NULL"
+            for id, title, priority, task_done, ctx_path in connection.execute(
+                query + condition, params
+            ):
+                yield TaskRecord(
+                    hex(id)[2:],
+                    sort_by,
+                    # todocli only shows priorities other than the default 1.
+                    None if priority == 1 else str(priority),
+                    ctx_path[1:] or None,
+                    title.strip(),
+                    "UNDONE" if task_done is None else "DONE",
+                )
+                sort_by += 1
+    finally:
+        connection.close()
+
+
+def read_tasks_data(data_dir, **filters):
+    """
+    Build the tasks snapshot from todocli's database.
+
+    Returns:
+        str: The JSON the `todo search`/`todo history` scraping produces, see `parsing_utils.parse_tasks_data`.
+    """
+    return encode_records(read_tasks(data_dir, **filters))
+
+
+if __name__ == "__main__":
+    serve_todocli_worker()
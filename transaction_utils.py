@@ -0,0 +1,126 @@
+import os
+import time
+import json
+import shutil
+import sqlite3
+import threading
+
+# The files todocli keeps in its data directory.
+TODOCLI_FILES = ("data.sqlite", "contexts", "version")
+# A request key seen this recently is taken to be a retry of the same request.
+JOURNAL_TTL_SECONDS = 10 * 60
+
+execution_journals = {}
+execution_journals_lock = threading.Lock()
+
+
+def copy_database(source, destination):
+    # SQLite's backup API copies a consistent state even while others read it,
+    # and writes into an existing destination in place.
+    source_connection = sqlite3.connect(source)
+    destination_connection = sqlite3.connect(destination)
+    try:
+        source_connection.backup(destination_connection)
+    finally:
+        destination_connection.close()
+        source_connection.close()
+
+
+def snapshot_data_dir(data_dir, snapshot_dir):
+    """
+    Copy todocli's files from its data directory.
+
+    Files that don't exist yet aren't copied, `restore_data_dir` removes them again.
+    """
+    for name in TODOCLI_FILES:
+        source = os.path.join(data_dir, name)
+        if not os.path.exists(source):
+            continue
+        if name == "data.sqlite":
+            copy_database(source, os.path.join(snapshot_dir, name))
+        else:
+            shutil.copy2(source, os.path.join(snapshot_dir, name))
+
+
+def restore_data_dir(snapshot_dir, data_dir):
+    """Put the files copied by `snapshot_data_dir` back into the data directory."""
+    for name in TODOCLI_FILES:
+        source = os.path.join(snapshot_dir, name)
+        destination = os.path.join(data_dir, name)
+        if not os.path.exists(source):
+            if os.path.exists(destination):
+                os.remove(destination)
+        elif name == "data.sqlite":
+            copy_database(source, destination)
+        else:
+            shutil.copy2(source, destination)
+
+
+class ExecutionJournal:
+    """
+    On-disk record of the requests that were carried out, by the caller's
+    request key (e.g. an Idempotency-Key), with their outcome.
+
+    A retry is recognised by its key alone, the LLM may well plan it
+    differently. A plan that was rolled back isn't recorded, so its request
+    can be run again. Entries expire `ttl` seconds after the first record.
+    """
+
+    def __init__(self, path, ttl=JOURNAL_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        self.connect().execute("""
+            CREATE TABLE IF NOT EXISTS requests (
+                key TEXT PRIMARY KEY,
+                outcome TEXT NOT NULL,
+                committed REAL NOT NULL
+            )
+            """)
+
+    def connect(self):
+        # One connection per thread, sqlite3 connections can't be shared.
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        """
+        Returns:
+            dict or None: The outcome recorded for the request, None if it wasn't applied or expired.
+        """
+        row = (
+            self.connect()
+            .execute("SELECT outcome, committed FROM requests WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def record(self, key, outcome):
+        # Replaces the outcome of the request, the commit time stays the first one.
+        connection = self.connect()
+        now = time.time()
+        connection.execute(
+            """
+            INSERT INTO requests VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET outcome = excluded.outcome
+            """,
+            (key, json.dumps(outcome), now),
+        )
+        connection.execute(
+            "DELETE FROM requests WHERE committed < ?", (now - self.ttl,)
+        )
+
+
+def get_execution_journal(path):
+    with execution_journals_lock:
+        # reset_todocli deletes the data directory and the journal with it.
+        journal = execution_journals.get(path)
+        if journal is None or not os.path.exists(path):
+            journal = ExecutionJournal(path)
+            execution_journals[path] = journal
+        return journal